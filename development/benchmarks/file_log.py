@@ -0,0 +1,60 @@
+"""
+Compares the WAL written and table growth of the old `ON CONFLICT DO UPDATE` upsert on `files`
+with `get_file_ids`, when every file is already known (a reimport of a deduplicated creator).
+Runs against a scratch copy of the `files` table in the configured database.
+Usage: `python -m development.benchmarks.file_log [number of files]`
+"""
+
+import sys
+import hashlib
+from datetime import datetime
+from psycopg2.extras import execute_values
+
+from src.internals.database import database
+from src.lib.files import get_file_ids
+
+def measure(conn, name, write):
+    cursor = conn.cursor()
+    cursor.execute("SELECT pg_current_wal_lsn() AS wal, pg_total_relation_size('files') AS size")
+    before = cursor.fetchone()
+    write(cursor)
+    conn.commit()
+    cursor.execute("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), %s) AS wal, pg_total_relation_size('files') AS size", (before['wal'],))
+    after = cursor.fetchone()
+    print(f"{name}: {int(after['wal']) / 1024:.0f} KiB of WAL, table grew by {(after['size'] - before['size']) / 1024:.0f} KiB")
+
+def legacy_upsert(entries):
+    def write(cursor):
+        for entry in entries:
+            cursor.execute("INSERT INTO files (hash, mtime, ctime, mime, ext) VALUES (%s, %s, %s, %s, %s) ON CONFLICT (hash) DO UPDATE SET hash = EXCLUDED.hash RETURNING id", (entry['fhash'], entry['mtime'], entry['ctime'], entry['mime'], entry['ext']))
+    return write
+
+def lookup_first(entries):
+    def write(cursor):
+        get_file_ids(cursor, entries)
+    return write
+
+if __name__ == '__main__':
+    amount = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    database.init()
+    conn = database.get_raw_conn()
+    entries = [
+        dict(fhash=hashlib.sha256(str(i).encode()).hexdigest(), mtime=datetime.now(), ctime=datetime.now(), mime='image/png', ext='.png')
+        for i in range(amount)
+    ]
+    cursor = conn.cursor()
+    # a scratch `files` table shadows the real one for this connection
+    cursor.execute('CREATE SCHEMA files_benchmark')
+    cursor.execute('CREATE TABLE files_benchmark.files (LIKE public.files INCLUDING ALL)')
+    cursor.execute('SET search_path TO files_benchmark')
+    execute_values(cursor, 'INSERT INTO files (hash, mtime, ctime, mime, ext) VALUES %s', [(e['fhash'], e['mtime'], e['ctime'], e['mime'], e['ext']) for e in entries])
+    conn.commit()
+    try:
+        measure(conn, 'ON CONFLICT DO UPDATE', legacy_upsert(entries))
+        measure(conn, 'lookup first', lookup_first(entries))
+    finally:
+        conn.rollback()
+        cursor.execute('RESET search_path')
+        cursor.execute('DROP SCHEMA files_benchmark CASCADE')
+        conn.commit()
+        database.return_conn(conn)
@@ -0,0 +1,40 @@
+"""
+Compares the old thumbnailer (full decode) with `render_thumbnail`.
+Usage: `python -m development.benchmarks.thumbnails <folder with images>`
+"""
+
+import sys
+import time
+from io import BytesIO
+from os import listdir
+from os.path import join, isfile, getsize
+from PIL import Image
+
+from src.internals.utils.thumbnail import render_thumbnail, save_thumbnail
+
+def legacy_thumbnail(path):
+    image = Image.open(path)
+    image = image.convert('RGB')
+    image.thumbnail((800, 800))
+    image.save(BytesIO(), 'JPEG', quality=60)
+
+def current_thumbnail(path):
+    save_thumbnail(render_thumbnail(path), BytesIO())
+
+def run(name, thumbnailer, paths):
+    total_bytes = sum(getsize(path) for path in paths)
+    failed = 0
+    start = time.perf_counter()
+    for path in paths:
+        try:
+            thumbnailer(path)
+        except Exception:
+            failed += 1
+    elapsed = time.perf_counter() - start
+    print(f'{name}: {len(paths)} files in {elapsed:.2f}s; {len(paths) / elapsed:.1f} images/s, {total_bytes / elapsed / 1024 / 1024:.1f} MB/s, {failed} failed')
+
+if __name__ == '__main__':
+    folder = sys.argv[1]
+    paths = [join(folder, name) for name in sorted(listdir(folder)) if isfile(join(folder, name))]
+    run('legacy', legacy_thumbnail, paths)
+    run('current', current_thumbnail, paths)
@@ -0,0 +1,11 @@
+"""
+Index file server relationships by remote path
+"""
+
+from yoyo import step
+
+__depends__ = {'20211028_01_k4D9Q-add-indexes-to-flag-table'}
+
+steps = [
+    step('CREATE INDEX file_server_relationships_remote_path_idx ON file_server_relationships USING btree ("remote_path")', 'DROP INDEX file_server_relationships_remote_path_idx')
+]
@@ -0,0 +1,15 @@
+"""
+Index file server relationships by file and remote path
+The unique index replacing this one is built by `src/internals/utils/file_dedup.py` once the existing duplicates are gone.
+"""
+
+from yoyo import step
+
+__depends__ = {'20261018_01_Qf3kD-index-file-server-relationships-by-remote-path'}
+
+steps = [
+    step(
+        'CREATE INDEX file_server_relationships_file_id_remote_path_idx ON file_server_relationships USING btree ("file_id", "remote_path")',
+        'DROP INDEX IF EXISTS file_server_relationships_file_id_remote_path_idx; DROP INDEX IF EXISTS file_server_relationships_file_id_remote_path_key'
+    )
+]
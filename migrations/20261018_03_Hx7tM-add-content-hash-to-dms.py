@@ -0,0 +1,47 @@
+"""
+Add content hash to dms
+Lets DMs be matched by content through an index instead of comparing the whole text.
+Must stay in sync with `get_dm_content_hash` in `src/lib/artist.py`.
+"""
+
+from yoyo import step
+
+__depends__ = {'20261018_02_Bv8sN-index-file-server-relationships-by-file-and-remote-path'}
+
+steps = [
+    step(
+        """
+        CREATE OR REPLACE FUNCTION set_dm_content_hash() RETURNS trigger AS $$
+        BEGIN
+            NEW.content_hash := encode(sha256(convert_to(btrim(NEW.content, E' \\t\\r\\n'), 'UTF8')), 'hex');
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        'DROP FUNCTION IF EXISTS set_dm_content_hash();'
+    ),
+    step(
+        """
+        ALTER TABLE dms ADD COLUMN content_hash varchar(64);
+        ALTER TABLE unapproved_dms ADD COLUMN content_hash varchar(64);
+        CREATE TRIGGER dms_content_hash BEFORE INSERT OR UPDATE OF content ON dms FOR EACH ROW EXECUTE PROCEDURE set_dm_content_hash();
+        CREATE TRIGGER unapproved_dms_content_hash BEFORE INSERT OR UPDATE OF content ON unapproved_dms FOR EACH ROW EXECUTE PROCEDURE set_dm_content_hash();
+        """,
+        """
+        DROP TRIGGER IF EXISTS unapproved_dms_content_hash ON unapproved_dms;
+        DROP TRIGGER IF EXISTS dms_content_hash ON dms;
+        ALTER TABLE unapproved_dms DROP COLUMN IF EXISTS content_hash;
+        ALTER TABLE dms DROP COLUMN IF EXISTS content_hash;
+        """
+    ),
+    step(
+        """
+        UPDATE dms SET content_hash = encode(sha256(convert_to(btrim(content, E' \\t\\r\\n'), 'UTF8')), 'hex') WHERE content_hash IS NULL;
+        UPDATE unapproved_dms SET content_hash = encode(sha256(convert_to(btrim(content, E' \\t\\r\\n'), 'UTF8')), 'hex') WHERE content_hash IS NULL;
+        """
+    ),
+    step(
+        'CREATE INDEX dms_service_user_content_hash_idx ON dms USING btree ("service", "user", "content_hash")',
+        'DROP INDEX IF EXISTS dms_service_user_content_hash_idx'
+    )
+]
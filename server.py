@@ -1,6 +1,4 @@
 from flask import Flask, g
-from yoyo import read_migrations
-from yoyo import get_backend
 import logging
 import uwsgi
 import config
@@ -9,11 +7,11 @@ from configs.derived_vars import is_development
 from src.endpoints.api import api
 from src.endpoints.icons import icons
 from src.endpoints.banners import banners
-from src.internals.database import database
+from src.internals.database import database, migrations
 from src.internals.cache import redis
 from src.internals.utils.flask_thread import FlaskThread
 from src.lib.artist import index_artists
-from src.internals.utils import key_watcher, indexer
+from src.internals.utils import key_watcher, indexer, file_dedup
 from src.internals.database.database import get_raw_conn
 
 app = Flask(__name__)
@@ -33,15 +31,15 @@ database.init()
 redis.init()
 
 if uwsgi.worker_id() == 0:
-    backend = get_backend(f'postgres://{config.database_user}:{config.database_password}@{config.database_host}/{config.database_dbname}')
-    migrations = read_migrations('./migrations')
-    with backend.lock():
-        backend.apply_migrations(backend.to_apply(migrations))
-    with app.app_context():
-        FlaskThread(target=indexer.run).start()
-    if (config.pubsub):
+    migrations.apply()
+    # otherwise background jobs and imports are left to `worker.py`
+    if getattr(config, 'embedded_worker', True):
         with app.app_context():
-            FlaskThread(target=key_watcher.watch).start()
+            FlaskThread(target=indexer.run).start()
+            FlaskThread(target=file_dedup.run).start()
+        if (config.pubsub):
+            with app.app_context():
+                FlaskThread(target=key_watcher.watch).start()
 
 @app.teardown_appcontext
 def close(e):
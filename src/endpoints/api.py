@@ -5,10 +5,16 @@ import config
 import threading
 
 from ..internals.utils import thread_master
-from ..internals.utils.flask_thread import FlaskThread
+from ..internals.utils.key_watcher import enqueue_import
 from ..internals.utils.utils import get_import_id
 from ..internals.utils.encryption import encrypt_and_log_session
 from ..internals.utils import logger
+from ..internals.utils.thumbnail import get_stats as get_thumbnail_stats
+from ..internals.utils.proxy import get_proxy_stats
+from ..internals.utils.rate_limiter import get_rate_limit_stats
+from ..internals.utils.concurrency import get_concurrency_stats
+from ..internals.utils.circuit_breaker import get_circuit_states
+from ..internals.utils.scrapper import get_scraper_stats
 from ..lib.import_manager import import_posts
 from ..lib.autoimport import decrypt_all_good_keys, log_import_id, revoke_v1_key, encrypt_and_save_session_for_auto_import
 from ..internals.utils.download import uniquify
@@ -23,6 +29,23 @@ from ..importers import fantia
 
 api = Blueprint('api', __name__)
 
+# run imports in this process; when off, they are queued for `worker.py`
+embedded_worker = getattr(config, 'embedded_worker', True)
+
+def start_import(import_id, target, args, data):
+    if not embedded_worker:
+        # manual imports are queued ahead of auto-imports; the worker logs the start
+        enqueue_import(import_id, data)
+        return
+    logger.log(import_id, f'Starting import. Your import id is {import_id}.')
+    thread_master.get_pool().submit(
+        import_posts, import_id, target, args,
+        priority=thread_master.AUTO_IMPORT if data['priority'] == 'auto_import' else thread_master.INTERACTIVE,
+        owner=data['contributor_id'],
+        service=data['service'],
+        log_id=import_id
+    )
+
 @api.route('/api/autoimport', methods=['POST'])
 def autoimport_api():
     prv_key = request.form.get('private_key')
@@ -47,7 +70,6 @@ def autoimport_api():
     except:
         return "Error while decrypting session tokens. The private key may be incorrect.", 401
 
-    threads = []
     for key in keys_to_import:
         import_id = get_import_id(key['decrypted_key'])
         target = None
@@ -72,10 +94,16 @@ def autoimport_api():
             args = (key['decrypted_key'], key['discord_channel_ids'], key['contributor_id'], False, key['id'])
 
         log_import_id(key['id'], import_id)
-        threads.append(FlaskThread(target=import_posts, args=(import_id, target, args)))
+        start_import(import_id, target, args, {
+            'import_id': import_id,
+            'key': key['decrypted_key'],
+            'key_id': key['id'],
+            'service': key['service'],
+            'channel_ids': key['discord_channel_ids'],
+            'contributor_id': key['contributor_id'],
+            'priority': 'auto_import'
+        })
 
-    FlaskThread(target=thread_master.run, args=(threads,)).run()
-    
     return '', 200
 
 @api.route('/api/import', methods=['POST'])
@@ -117,8 +145,16 @@ def import_api():
         args = (key, channel_ids.strip().replace(" ", ""), contributor_id, allowed_to_auto_import, None)
 
     if target is not None and args is not None:
-        logger.log(import_id, f'Starting import. Your import id is {import_id}.')
-        FlaskThread(target=import_posts, args=(import_id, target, args)).start()
+        start_import(import_id, target, args, {
+            'import_id': import_id,
+            'key': key,
+            'service': service,
+            'auto_import': allowed_to_auto_import,
+            'save_dms': allowed_to_scrape_dms,
+            'channel_ids': channel_ids,
+            'contributor_id': contributor_id,
+            'priority': 'interactive'
+        })
     else:
         logger.log(import_id, f'Error starting import. Your import id is {import_id}.')
 
@@ -141,4 +177,32 @@ def upload_file(path):
 
 @api.route('/api/active_imports', methods=['GET'])
 def get_thread_count():
-    return str(threading.active_count()), 200
\ No newline at end of file
+    return str(threading.active_count()), 200
+
+@api.route('/api/thumbnails', methods=['GET'])
+def get_thumbnails_status():
+    return json.dumps(get_thumbnail_stats()), 200
+
+@api.route('/api/proxies', methods=['GET'])
+def get_proxies_status():
+    return json.dumps(get_proxy_stats()), 200
+
+@api.route('/api/rate_limits', methods=['GET'])
+def get_rate_limits_status():
+    return json.dumps(get_rate_limit_stats()), 200
+
+@api.route('/api/concurrency', methods=['GET'])
+def get_concurrency_status():
+    return json.dumps(get_concurrency_stats()), 200
+
+@api.route('/api/circuits', methods=['GET'])
+def get_circuits_status():
+    return json.dumps(get_circuit_states()), 200
+
+@api.route('/api/scrapers', methods=['GET'])
+def get_scrapers_status():
+    return json.dumps(get_scraper_stats()), 200
+
+@api.route('/api/jobs', methods=['GET'])
+def get_jobs_status():
+    return json.dumps(thread_master.get_pool().get_stats()), 200
@@ -1,14 +1,15 @@
 from flask import Blueprint, redirect, current_app
 
 import config
-import requests
-import cloudscraper
+from requests.exceptions import HTTPError
 from os import makedirs
 from os.path import exists, join
 from bs4 import BeautifulSoup
 
 from ..internals.utils.download import download_branding
 from ..internals.utils.proxy import get_proxy
+from ..internals.utils.scrapper import create_scrapper_session
+from ..internals.utils.session_pool import get_session
 
 banners = Blueprint('banners', __name__)
 
@@ -18,7 +19,7 @@ def import_banner(service, user):
     if not exists(join(config.download_path, 'banners', service, user)):
         try:
             if service == 'patreon':
-                scraper = cloudscraper.create_scraper().get('https://api.patreon.com/user/' + user, proxies=get_proxy())
+                scraper = create_scrapper_session().get('https://api.patreon.com/user/' + user, proxies=get_proxy())
                 data = scraper.json()
                 scraper.raise_for_status()
                 if data.get('included') and data['included'][0]['attributes'].get('cover_photo_url'):
@@ -30,7 +31,7 @@ def import_banner(service, user):
                 else:
                     raise BannerException()
             elif service == 'fanbox':
-                scraper = requests.get('https://api.fanbox.cc/creator.get?userId=' + user, headers={"origin":"https://fanbox.cc"}, proxies=get_proxy())
+                scraper = get_session().get('https://api.fanbox.cc/creator.get?userId=' + user, headers={"origin":"https://fanbox.cc"}, proxies=get_proxy())
                 data = scraper.json()
                 scraper.raise_for_status()
                 if data['body']['coverImageUrl']:
@@ -42,7 +43,7 @@ def import_banner(service, user):
                 else:
                     raise BannerException()
             elif service == 'subscribestar':
-                scraper = cloudscraper.create_scraper()
+                scraper = create_scrapper_session()
                 resp = scraper.get('https://subscribestar.adult/' + user, proxies=get_proxy())
                 data = resp.text
                 resp.raise_for_status()
@@ -56,7 +57,7 @@ def import_banner(service, user):
                 else:
                     raise BannerException()
             elif service == 'fantia':
-                scraper = requests.get('https://fantia.jp/api/v1/fanclubs/' + user, proxies=get_proxy())
+                scraper = get_session().get('https://fantia.jp/api/v1/fanclubs/' + user, proxies=get_proxy())
                 data = scraper.json()
                 scraper.raise_for_status()
                 if data['fanclub']['cover']:
@@ -74,7 +75,7 @@ def import_banner(service, user):
             current_app.logger.exception(f'Error importing banner for {user} on {service}')
             with open(join(config.download_path, 'banners', service, user), 'w') as _:
                 pass
-        except requests.HTTPError as e:
+        except HTTPError as e:
             if e.response.status_code == 404:
                 with open(join(config.download_path, 'banners', service, user), 'w') as _:
                     pass
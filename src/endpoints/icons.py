@@ -3,14 +3,15 @@ from flask import Blueprint, redirect, current_app
 import re
 import cssutils
 import config
-import requests
-import cloudscraper
+from requests.exceptions import HTTPError
 from os import makedirs
 from os.path import exists, join
 from bs4 import BeautifulSoup
 
 from ..internals.utils.download import download_branding
 from ..internals.utils.proxy import get_proxy
+from ..internals.utils.scrapper import create_scrapper_session
+from ..internals.utils.session_pool import get_session
 
 icons = Blueprint('icons', __name__)
 
@@ -20,7 +21,7 @@ def import_icon(service, user):
     if not exists(join(config.download_path, 'icons', service, user)):
         try:
             if service == 'patreon':
-                scraper = cloudscraper.create_scraper().get('https://api.patreon.com/user/' + user, proxies=get_proxy())
+                scraper = create_scrapper_session().get('https://api.patreon.com/user/' + user, proxies=get_proxy())
                 data = scraper.json()
                 scraper.raise_for_status()
                 download_branding(
@@ -29,7 +30,7 @@ def import_icon(service, user):
                     name = user
                 )
             elif service == 'fanbox':
-                scraper = requests.get('https://api.fanbox.cc/creator.get?userId=' + user, headers={"origin":"https://fanbox.cc"}, proxies=get_proxy())
+                scraper = get_session().get('https://api.fanbox.cc/creator.get?userId=' + user, headers={"origin":"https://fanbox.cc"}, proxies=get_proxy())
                 data = scraper.json()
                 scraper.raise_for_status()
                 if data['body']['user']['iconUrl']:
@@ -41,7 +42,7 @@ def import_icon(service, user):
                 else:
                     raise IconsException()
             elif service == 'subscribestar':
-                scraper = cloudscraper.create_scraper()
+                scraper = create_scrapper_session()
                 resp = scraper.get('https://subscribestar.adult/' + user, proxies=get_proxy())
                 data = resp.text
                 resp.raise_for_status()
@@ -52,7 +53,7 @@ def import_icon(service, user):
                     name = user
                 )
             elif service == 'gumroad':
-                scraper = cloudscraper.create_scraper()
+                scraper = create_scrapper_session()
                 resp = scraper.get('https://gumroad.com/' + user, proxies=get_proxy())
                 data = resp.text
                 resp.raise_for_status()
@@ -65,7 +66,7 @@ def import_icon(service, user):
                     name = user
                 )
             elif service == 'fantia':
-                scraper = requests.get('https://fantia.jp/api/v1/fanclubs/' + user, proxies=get_proxy())
+                scraper = get_session().get('https://fantia.jp/api/v1/fanclubs/' + user, proxies=get_proxy())
                 data = scraper.json()
                 scraper.raise_for_status()
                 if data['fanclub']['icon']:
@@ -83,7 +84,7 @@ def import_icon(service, user):
             current_app.logger.exception(f'Exception when downloading icons for user {user} on {service}')
             with open(join(config.download_path, 'icons', service, user), 'w') as _: 
                 pass
-        except requests.HTTPError as e:
+        except HTTPError as e:
             if e.response.status_code == 404:
                 with open(join(config.download_path, 'icons', service, user), 'w') as _: 
                     pass
@@ -15,11 +15,14 @@ from ..internals.cache.redis import delete_keys
 from ..internals.utils.logger import log
 from ..internals.utils.scrapper import create_scrapper_session
 from ..internals.utils.proxy import get_proxy
-from ..internals.database.database import get_conn, get_raw_conn, return_conn
+from ..internals.database.database import get_conn
 from ..lib.autoimport import encrypt_and_save_session_for_auto_import, kill_key
-from ..lib.artist import index_discord_channel_server, is_artist_dnp
-from ..lib.post import discord_post_exists
-from ..internals.utils.download import download_file, DownloaderException
+from ..lib.artist import index_discord_channel_server
+from ..lib.dnp import is_dnp
+from ..lib.post import get_existing_discord_post_ids
+from ..lib.page_writer import PageWriter
+from ..internals.utils.download import DownloaderException
+from ..internals.utils.download_pool import download_files
 
 userAgent = 'Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) discord/0.0.305 Chrome/69.0.3497.128 Electron/4.0.8 Safari/537.36'
 
@@ -57,7 +60,7 @@ def import_channel(channel_id, import_id, key):
         log(import_id, 'Error connecting to cloudscraper. Please try again.', 'exception')
         return
 
-    if is_artist_dnp('discord', channel_data['guild_id']):
+    if is_dnp('discord', channel_data['guild_id']):
         log(import_id, f"Skipping channel {channel_id} because server {channel_data['guild_id']} is in do not post list", to_client = True)
         return
     
@@ -93,12 +96,14 @@ def process_channel(channel_id, server_id, import_id, key, before = None):
         log(import_id, 'Error connecting to cloudscraper. Please try again.', 'exception')
         return False
 
+    posts_writer = PageWriter('discord_posts', ['id', 'server', 'channel'], casts = { 'embeds': 'jsonb[]', 'mentions': 'jsonb[]', 'attachments': 'jsonb[]' }, import_id = import_id)
     while True:
+        existing_post_ids = get_existing_discord_post_ids(server_id, channel_id, [post['id'] for post in scraper_data])
         for post in scraper_data:
             try:
                 post_id = post['id']    
     
-                if discord_post_exists(server_id, channel_id, post_id): #todo: post re-importing for discord?
+                if post_id in existing_post_ids: #todo: post re-importing for discord?
                     log(import_id, f'Skipping post {post_id} from server {server_id} because it already exists', to_client = True)
                     continue
                 
@@ -119,19 +124,21 @@ def process_channel(channel_id, server_id, import_id, key, before = None):
                 }
     
                 if('attachments' in post and len(post['attachments']) > 0):
+                    download_jobs = []
                     for attachment in post['attachments']:
-                        filename = attachment['filename']
-                        reported_filename, hash_filename, _ = download_file(
+                        download_jobs.append(((
                             attachment['url'] if 'url' in attachment and attachment['url'] != None else attachment['proxy_url'],
                             None,
                             None,
-                            None,
-                            name = filename,
-                            discord = True,
-                            discord_message_server = server_id,
-                            discord_message_channel = channel_id,
-                            discord_message_id = post_id
-                        )
+                            None
+                        ), {
+                            'name': attachment['filename'],
+                            'discord': True,
+                            'discord_message_server': server_id,
+                            'discord_message_channel': channel_id,
+                            'discord_message_id': post_id
+                        }))
+                    for reported_filename, hash_filename, _ in download_files(download_jobs):
                         post_model['attachments'].append({
                             'name': reported_filename,
                             'path': hash_filename
@@ -145,36 +152,19 @@ def process_channel(channel_id, server_id, import_id, key, before = None):
                 for i in range(len(post_model['attachments'])):
                     post_model['attachments'][i] = json.dumps(post_model['attachments'][i])
                 
-                columns = post_model.keys()
-                data = ['%s'] * len(post_model.values())
-                data[-3] = '%s::jsonb[]' # embeds
-                data[-2] = '%s::jsonb[]' # mentions
-                data[-1] = '%s::jsonb[]' # attachments
-    
-                query = "INSERT INTO discord_posts ({fields}) VALUES ({values}) ON CONFLICT (id, server, channel) DO UPDATE SET {updates}".format(
-                    fields = ','.join(columns),
-                    values = ','.join(data),
-                    updates = ','.join([f'{column}=EXCLUDED.{column}' for column in columns])
-                )
-    
-                conn = get_raw_conn()
-                try:
-                    cursor = conn.cursor()
-                    cursor.execute(query, list(post_model.values()))
-                    conn.commit()
-                finally:
-                    return_conn(conn)
-    
-                if (config.ban_url):
-                    requests.request('BAN', f"{config.ban_url}/discord/server/{post_model['server']}")
-                    requests.request('BAN', f"{config.ban_url}/api/discord/channel/{post_model['channel']}")
-                    requests.request('BAN', f"{config.ban_url}/api/discord/channels/lookup?q={post_model['server']}")
-    
-                log(import_id, f"Finished importing {post_id} from channel {channel_id}", to_client = False)    
+                posts_writer.add(post_model, after = [
+                    *([
+                        (requests.request, 'BAN', f"{config.ban_url}/discord/server/{post_model['server']}"),
+                        (requests.request, 'BAN', f"{config.ban_url}/api/discord/channel/{post_model['channel']}"),
+                        (requests.request, 'BAN', f"{config.ban_url}/api/discord/channels/lookup?q={post_model['server']}")
+                    ] if config.ban_url else []),
+                    (log, import_id, f"Finished importing {post_id} from channel {channel_id}", 'debug', False)
+                ])
             except Exception as e:
                 log(import_id, f"Error while importing {post_id} from channel {channel_id}", 'exception', True)
                 continue
     
+        posts_writer.flush()
         if(len(scraper_data) >= 50):
             time.sleep(randrange(500, 1250) / 1000)
             try:
@@ -14,17 +14,21 @@ from flask import current_app
 from PixivUtil2.PixivModelFanbox import FanboxArtist, FanboxPost
 
 from ..internals.cache.redis import delete_keys
-from ..internals.database.database import get_conn, get_raw_conn, return_conn
-from ..lib.artist import index_artists, is_artist_dnp, update_artist, delete_artist_cache_keys, delete_comment_cache_keys, get_all_artist_post_ids, get_all_artist_flagged_post_ids, get_all_dnp
-from ..lib.post import post_flagged, post_exists, delete_post_flags, move_to_backup, delete_backup, restore_from_backup, comment_exists, get_comments_for_posts
+from ..internals.database.database import get_conn
+from ..lib.artist import index_artists, update_artist, delete_artist_cache_keys, delete_comment_cache_keys
+from ..lib.existence_index import PostExistenceIndex
+from ..lib.dnp import is_dnp
+from ..lib.page_writer import PageWriter
+from ..lib.post import delete_post_flags, get_existing_comment_ids
 from ..lib.autoimport import encrypt_and_save_session_for_auto_import, kill_key
 from ..internals.utils.proxy import get_proxy
-from ..internals.utils.download import download_file, DownloaderException
+from ..internals.utils.download import DownloaderException
+from ..internals.utils.download_pool import download_files
 from ..internals.utils.utils import get_import_id
 from ..internals.utils.logger import log
 from ..internals.utils.scrapper import create_scrapper_session
 
-def import_comment(comment, user_id, post_id, import_id):
+def import_comment(comment, user_id, post_id, import_id, comments_writer):
     commenter_id = comment['user']['userId']
     comment_id = comment['id']
     
@@ -41,27 +45,14 @@ def import_comment(comment, user_id, post_id, import_id):
         'published': comment['createdDatetime'],
     }
 
-    columns = post_model.keys()
-    data = ['%s'] * len(post_model.values())
-    query = "INSERT INTO comments ({fields}) VALUES ({values})".format(
-        fields = ','.join(columns),
-        values = ','.join(data)
-    )
-    conn = get_raw_conn()
-    try:
-        cursor = conn.cursor()
-        cursor.execute(query, list(post_model.values()))
-        conn.commit()
-    finally:
-        return_conn(conn)
+    comments_writer.add(post_model, after = [
+        *([(requests.request, 'BAN', f"{config.ban_url}/{post_model['service']}/user/" + user_id + '/post/' + post_model['post_id'])] if config.ban_url else []),
+        (delete_comment_cache_keys, post_model['service'], user_id, post_model['post_id'])
+    ])
 
     if comment.get('replies'):
         for comment in comment['replies']:
-            import_comment(comment, user_id, post_id, import_id)
-    
-    if (config.ban_url):
-        requests.request('BAN', f"{config.ban_url}/{post_model['service']}/user/" + user_id + '/post/' + post_model['post_id'])
-    delete_comment_cache_keys(post_model['service'], user_id, post_model['post_id'])
+            import_comment(comment, user_id, post_id, import_id, comments_writer)
 
 def import_comments(key, post_id, user_id, import_id, url = None):
     if not url:
@@ -80,21 +71,22 @@ def import_comments(key, post_id, user_id, import_id, url = None):
         log(import_id, f'HTTP error when contacting Fanbox API ({url}). No comments will be imported.', 'exception')
         return
     
-    all_comments = get_comments_for_posts('fanbox', post_id)
+    comments_writer = PageWriter('comments', ['id', 'service'], update = False, import_id = import_id)
     if scraper_data.get('body'):
         while True:
+            existing_comment_ids = get_existing_comment_ids('fanbox', [comment['id'] for comment in scraper_data['body']['items']])
             for comment in scraper_data['body']['items']:
                 comment_id = comment['id']
-                commenter_id = comment['user']['userId']
                 try:
-                    if len(list(filter(lambda comment: comment['id'] == post_id and comment['commenter'] == commenter_id, all_comments))) > 0:
+                    if comment_id in existing_comment_ids:
                         log(import_id, f"Skipping comment {comment_id} from post {post_id} because already exists", to_client = False)
                         continue
-                    import_comment(comment, user_id, post_id, import_id)
+                    import_comment(comment, user_id, post_id, import_id, comments_writer)
                 except Exception as e:
                     log(import_id, f"Error while importing comment {comment_id} from post {post_id}", 'exception', True)
                     continue
                 
+            comments_writer.flush()
             next_url = scraper_data['body'].get('nextUrl')
             if next_url:
                 log(import_id, f"Processing next page of comments for post {post_id}", to_client = False)
@@ -139,9 +131,8 @@ def import_posts(import_id, key, contributor_id = None, allowed_to_auto_import =
             log(import_id, f"An error occured while saving your key for auto-import.", 'exception')
     
     user_id = None
-    dnp = get_all_dnp()
-    post_ids_of_users = {}
-    flagged_post_ids_of_users = {}
+    existing_posts = PostExistenceIndex('fanbox', import_id)
+    posts_writer = PageWriter('posts', ['id', 'service'], casts = { 'attachments': 'jsonb[]' }, import_id = import_id)
     if scraper_data.get('body'):
         while True:
             for post in scraper_data['body']['items']:
@@ -153,18 +144,14 @@ def import_posts(import_id, key, contributor_id = None, allowed_to_auto_import =
                     log(import_id, f'Skipping post {post_id} from user {user_id} because post is from higher subscription tier')
                     continue
                 try:
-                    if len(list(filter(lambda artist: artist['id'] == user_id and artist['service'] == 'fanbox', dnp))) > 0:
+                    if is_dnp('fanbox', user_id):
                         log(import_id, f"Skipping post {post_id} from user {user_id} is in do not post list")
                         continue
 
                     import_comments(key, post_id, user_id, import_id)
 
                     # existence checking
-                    if not post_ids_of_users.get(user_id):
-                        post_ids_of_users[user_id] = get_all_artist_post_ids('fanbox', user_id)
-                    if not flagged_post_ids_of_users.get(user_id):
-                        flagged_post_ids_of_users[user_id] = get_all_artist_flagged_post_ids('fanbox', user_id)
-                    if len(list(filter(lambda post: post['id'] == post_id, post_ids_of_users[user_id]))) > 0 and len(list(filter(lambda flag: flag['id'] == post_id, flagged_post_ids_of_users[user_id]))) == 0:
+                    if existing_posts.should_skip(user_id, post_id):
                         log(import_id, f'Skipping post {post_id} from user {user_id} because already exists', to_client = True)
                         continue
 
@@ -185,6 +172,8 @@ def import_posts(import_id, key, contributor_id = None, allowed_to_auto_import =
                         'attachments': []
                     }
 
+                    download_jobs = []
+                    download_is_main_file = []
                     for i in range(len(parsed_post.embeddedFiles)):
                         if type(parsed_post.embeddedFiles[i]) is dict:
                             if parsed_post.embeddedFiles[i]['serviceProvider'] == 'twitter':
@@ -242,64 +231,45 @@ def import_posts(import_id, key, contributor_id = None, allowed_to_auto_import =
                                     <br>
                                 """
                         elif type(parsed_post.embeddedFiles[i]) is str:
-                            if i == 0:
-                                reported_filename, hash_filename, _ = download_file(
-                                    parsed_post.embeddedFiles[i],
-                                    'fanbox',
-                                    user_id,
-                                    post_id,
-                                    cookies={ 'FANBOXSESSID': key },
-                                    headers={ 'origin': 'https://fanbox.cc' }
-                                )
-                                post_model['file']['name'] = reported_filename
-                                post_model['file']['path'] = hash_filename
-                            else:
-                                reported_filename, hash_filename, _ = download_file(
-                                    parsed_post.embeddedFiles[i],
-                                    'fanbox',
-                                    user_id,
-                                    post_id,
-                                    cookies={ 'FANBOXSESSID': key },
-                                    headers={ 'origin': 'https://fanbox.cc' }
-                                )
-                                post_model['attachments'].append({
-                                    'name': reported_filename,
-                                    'path': hash_filename
-                                })
+                            # the first file is the post's main file, the rest are attachments
+                            download_jobs.append(((
+                                parsed_post.embeddedFiles[i],
+                                'fanbox',
+                                user_id,
+                                post_id
+                            ), {
+                                'cookies': { 'FANBOXSESSID': key },
+                                'headers': { 'origin': 'https://fanbox.cc' }
+                            }))
+                            download_is_main_file.append(i == 0)
+
+                    for is_main_file, (reported_filename, hash_filename, _) in zip(download_is_main_file, download_files(download_jobs)):
+                        if is_main_file:
+                            post_model['file']['name'] = reported_filename
+                            post_model['file']['path'] = hash_filename
+                        else:
+                            post_model['attachments'].append({
+                                'name': reported_filename,
+                                'path': hash_filename
+                            })
 
                     post_model['embed'] = json.dumps(post_model['embed'])
                     post_model['file'] = json.dumps(post_model['file'])
                     for i in range(len(post_model['attachments'])):
                         post_model['attachments'][i] = json.dumps(post_model['attachments'][i])
 
-                    columns = post_model.keys()
-                    data = ['%s'] * len(post_model.values())
-                    data[-1] = '%s::jsonb[]' # attachments
-                    query = "INSERT INTO posts ({fields}) VALUES ({values}) ON CONFLICT (id, service) DO UPDATE SET {updates}".format(
-                        fields = ','.join(columns),
-                        values = ','.join(data),
-                        updates = ','.join([f'{column}=EXCLUDED.{column}' for column in columns])
-                    )
-                    conn = get_raw_conn()
-                    try:
-                        cursor = conn.cursor()
-                        cursor.execute(query, list(post_model.values()))
-                        conn.commit()
-                    finally:
-                        return_conn(conn)
-
-                    update_artist('fanbox', user_id)
-                    delete_post_flags('fanbox', user_id, post_id)
-
-                    if (config.ban_url):
-                        requests.request('BAN', f"{config.ban_url}/{post_model['service']}/user/" + post_model['"user"'])
-                    delete_artist_cache_keys('fanbox', user_id)
-
-                    log(import_id, f'Finished importing {post_id} for user {user_id}', to_client = False)
+                    posts_writer.add(post_model, after = [
+                        (update_artist, 'fanbox', user_id),
+                        (delete_post_flags, 'fanbox', user_id, post_id),
+                        *([(requests.request, 'BAN', f"{config.ban_url}/{post_model['service']}/user/" + post_model['"user"'])] if config.ban_url else []),
+                        (delete_artist_cache_keys, 'fanbox', user_id),
+                        (log, import_id, f'Finished importing {post_id} for user {user_id}', 'debug', False)
+                    ])
                 except Exception as e:
                     log(import_id, f'Error importing post {post_id} from user {user_id}', 'exception')
                     continue
                 
+            posts_writer.flush()
             next_url = scraper_data['body'].get('nextUrl')
             if next_url:
                 try:
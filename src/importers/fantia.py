@@ -10,12 +10,16 @@ from os.path import join
 from bs4 import BeautifulSoup
 
 from ..internals.cache.redis import delete_keys
-from ..internals.database.database import get_conn, get_raw_conn, return_conn
+from ..internals.database.database import get_conn
 from ..internals.utils.logger import log
-from ..lib.artist import index_artists, is_artist_dnp, update_artist, delete_artist_cache_keys, get_all_artist_post_ids, get_all_artist_flagged_post_ids, get_all_dnp
-from ..lib.post import post_flagged, post_exists, delete_post_flags, move_to_backup, delete_backup, restore_from_backup
+from ..lib.artist import index_artists, update_artist, delete_artist_cache_keys
+from ..lib.existence_index import PostExistenceIndex
+from ..lib.dnp import is_dnp
+from ..lib.page_writer import PageWriter
+from ..lib.post import delete_post_flags
 from ..lib.autoimport import encrypt_and_save_session_for_auto_import, kill_key
-from ..internals.utils.download import download_file, DownloaderException
+from ..internals.utils.download import DownloaderException
+from ..internals.utils.download_pool import download_files
 from ..internals.utils.scrapper import create_scrapper_session
 from ..internals.utils.proxy import get_proxy
 
@@ -89,25 +93,21 @@ def import_fanclub(fanclub_id, import_id, jar, page = 1):
     
     scraped_posts = BeautifulSoup(scraper_data, 'html.parser').select('div.post')
     user_id = None
-    dnp = get_all_dnp()
-    post_ids_of_users = {}
-    flagged_post_ids_of_users = {}
+    existing_posts = PostExistenceIndex('fantia', import_id)
+    posts_writer = PageWriter('posts', ['id', 'service'], casts = { 'attachments': 'jsonb[]' }, import_id = import_id)
     while True:
         for post in scraped_posts:
             try:
                 user_id = fanclub_id
                 post_id = post.select_one('a.link-block')['href'].lstrip('/posts/')
     
-                if len(list(filter(lambda artist: artist['id'] == user_id and artist['service'] == 'fantia', dnp))) > 0:
+                if is_dnp('fantia', user_id):
                     log(import_id, f"Skipping user {user_id} because they are in do not post list", to_client = True)
+                    posts_writer.flush()
                     return     
     
                 # existence checking
-                if not post_ids_of_users.get(user_id):
-                    post_ids_of_users[user_id] = get_all_artist_post_ids('fantia', user_id)
-                if not flagged_post_ids_of_users.get(user_id):
-                    flagged_post_ids_of_users[user_id] = get_all_artist_flagged_post_ids('fantia', user_id)
-                if len(list(filter(lambda post: post['id'] == post_id, post_ids_of_users[user_id]))) > 0 and len(list(filter(lambda flag: flag['id'] == post_id, flagged_post_ids_of_users[user_id]))) == 0:
+                if existing_posts.should_skip(user_id, post_id):
                     log(import_id, f'Skipping post {post_id} from user {user_id} because already exists', to_client = True)
                     continue
                 
@@ -147,45 +147,21 @@ def import_fanclub(fanclub_id, import_id, jar, page = 1):
                     
                 log(import_id, f"Starting import: {post_id} from user {user_id}")
     
+                # all files of the post are collected first and downloaded together
+                file_jobs = []
+                attachment_jobs = []
+
                 if post_data['post']['thumb']:
-                    reported_filename, hash_filename, _ = download_file(
-                        post_data['post']['thumb']['original'],
-                        'fantia',
-                        user_id,
-                        post_id,
-                    )
-                    post_model['file']['name'] = reported_filename
-                    post_model['file']['path'] = hash_filename
+                    file_jobs.append(((post_data['post']['thumb']['original'], 'fantia', user_id, post_id), {}))
     
                 for content in post_data['post']['post_contents']:
                     if (content['visible_status'] != 'visible'):
                         continue
                     if content['category'] == 'photo_gallery':
                         for photo in content['post_content_photos']:
-                            reported_filename, hash_filename, _ = download_file(
-                                photo['url']['original'],
-                                'fantia',
-                                user_id,
-                                post_id,
-                                cookies=jar
-                            )
-                            post_model['attachments'].append({
-                                'name': reported_filename,
-                                'path': hash_filename
-                            })
+                            attachment_jobs.append(((photo['url']['original'], 'fantia', user_id, post_id), { 'cookies': jar }))
                     elif content['category'] == 'file':
-                        reported_filename, hash_filename, _ = download_file(
-                            urljoin('https://fantia.jp/posts', content['download_uri']),
-                            'fantia',
-                            user_id,
-                            post_id,
-                            name = content['filename'],
-                            cookies=jar
-                        )
-                        post_model['attachments'].append({
-                            'name': reported_filename,
-                            'path': hash_filename
-                        })
+                        attachment_jobs.append(((urljoin('https://fantia.jp/posts', content['download_uri']), 'fantia', user_id, post_id), { 'name': content['filename'], 'cookies': jar }))
                     elif content['category'] == 'embed':
                         post_model['content'] += f"""
                             <a href="{content['embed_url']}" target="_blank">
@@ -198,56 +174,39 @@ def import_fanclub(fanclub_id, import_id, jar, page = 1):
                     elif content['category'] == 'blog':
                         for op in json.loads(content['comment'])['ops']:
                             if type(op['insert']) is dict and op['insert'].get('fantiaImage'):
-                                reported_filename, hash_filename, _ = download_file(
-                                    urljoin('https://fantia.jp/', op['insert']['fantiaImage']['original_url']),
-                                    'fantia',
-                                    user_id,
-                                    post_id,
-                                    cookies=jar
-                                )
-                                post_model['attachments'].append({
-                                    'name': reported_filename,
-                                    'path': hash_filename
-                                })
+                                attachment_jobs.append(((urljoin('https://fantia.jp/', op['insert']['fantiaImage']['original_url']), 'fantia', user_id, post_id), { 'cookies': jar }))
                     else:
                         log(import_id, f'Skipping content {content["id"]} from post {post_id}; unsupported type "{content["category"]}"', to_client = True)
                         log(import_id, json.dumps(content), to_client=False)
+
+                results = download_files(file_jobs + attachment_jobs)
+                for reported_filename, hash_filename, _ in results[:len(file_jobs)]:
+                    post_model['file']['name'] = reported_filename
+                    post_model['file']['path'] = hash_filename
+                for reported_filename, hash_filename, _ in results[len(file_jobs):]:
+                    post_model['attachments'].append({
+                        'name': reported_filename,
+                        'path': hash_filename
+                    })
                 
                 post_model['embed'] = json.dumps(post_model['embed'])
                 post_model['file'] = json.dumps(post_model['file'])
                 for i in range(len(post_model['attachments'])):
                     post_model['attachments'][i] = json.dumps(post_model['attachments'][i])
     
-                columns = post_model.keys()
-                data = ['%s'] * len(post_model.values())
-                data[-1] = '%s::jsonb[]' # attachments
-                query = "INSERT INTO posts ({fields}) VALUES ({values}) ON CONFLICT (id, service) DO UPDATE SET {updates}".format(
-                    fields = ','.join(columns),
-                    values = ','.join(data),
-                    updates = ','.join([f'{column}=EXCLUDED.{column}' for column in columns])
-                )
-                
-                conn = get_raw_conn()
-                try:
-                    cursor = conn.cursor()
-                    cursor.execute(query, list(post_model.values()))
-                    conn.commit()
-                finally:
-                    return_conn(conn)
-    
-                update_artist('fantia', user_id)
-                delete_post_flags('fantia', user_id, post_id)
-                
-                if (config.ban_url):
-                    requests.request('BAN', f"{config.ban_url}/{post_model['service']}/user/" + post_model['"user"'])
-                delete_artist_cache_keys('fantia', user_id)
-    
-                log(import_id, f"Finished importing {post_id} from user {user_id}", to_client=False)
+                posts_writer.add(post_model, after = [
+                    (update_artist, 'fantia', user_id),
+                    (delete_post_flags, 'fantia', user_id, post_id),
+                    *([(requests.request, 'BAN', f"{config.ban_url}/{post_model['service']}/user/" + post_model['"user"'])] if config.ban_url else []),
+                    (delete_artist_cache_keys, 'fantia', user_id),
+                    (log, import_id, f"Finished importing {post_id} from user {user_id}", 'debug', False)
+                ])
             except Exception:
                 log(import_id, f'Error importing post {post_id} from user {user_id}', 'exception')
                 
                 continue
         
+        posts_writer.flush()
         if (scraped_posts):
             log(import_id, f'Finished processing page. Processing next page.')
             page = page + 1
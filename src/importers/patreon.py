@@ -20,13 +20,17 @@ from gallery_dl import text
 
 from flask import current_app
 
-from ..internals.database.database import get_conn, get_raw_conn, return_conn
-from ..lib.artist import index_artists, is_artist_dnp, update_artist, delete_artist_cache_keys, dm_exists, delete_comment_cache_keys, delete_dm_cache_keys, get_all_artist_post_ids, get_all_artist_flagged_post_ids, get_all_dnp
-from ..lib.post import post_flagged, post_exists, delete_post_flags, move_to_backup, delete_backup, restore_from_backup, comment_exists, get_comments_for_posts
+from ..internals.database.database import get_conn
+from ..lib.artist import index_artists, update_artist, delete_artist_cache_keys, get_existing_dm_ids, delete_comment_cache_keys, delete_dm_cache_keys
+from ..lib.existence_index import PostExistenceIndex
+from ..lib.dnp import is_dnp
+from ..lib.page_writer import PageWriter
+from ..lib.post import delete_post_flags, get_existing_comment_ids
 from ..lib.autoimport import encrypt_and_save_session_for_auto_import, kill_key
 from ..internals.cache.redis import delete_keys
-from ..internals.utils.download import download_file, DownloaderException
-from ..internals.utils.proxy import get_proxy
+from ..internals.utils.download import DownloaderException
+from ..internals.utils.download_pool import download_files
+from ..internals.utils.proxy import get_proxy, report_proxy
 from ..internals.utils.logger import log
 from ..internals.utils.scrapper import create_scrapper_session
 
@@ -343,13 +347,20 @@ def get_ws_connection(url):
     proxy = get_proxy()
     if (proxy):
         proxy_url = urlparse(proxy['https'])
-        return create_connection(
-            url,
-            http_proxy_host=proxy_url.hostname,
-            http_proxy_port=proxy_url.port,
-            http_proxy_auth=(proxy_url.username, proxy_url.password) if proxy_url.username and proxy_url.password else None,
-            proxy_type=proxy_url.scheme
-        )
+        start = time.monotonic()
+        try:
+            connection = create_connection(
+                url,
+                http_proxy_host=proxy_url.hostname,
+                http_proxy_port=proxy_url.port,
+                http_proxy_auth=(proxy_url.username, proxy_url.password) if proxy_url.username and proxy_url.password else None,
+                proxy_type=proxy_url.scheme
+            )
+        except Exception:
+            report_proxy(proxy, False)
+            raise
+        report_proxy(proxy, True, time.monotonic() - start)
+        return connection
     else:
         return create_connection(url)
 
@@ -503,6 +514,11 @@ def import_channel(auth_token, url, import_id, current_user, contributor_id, tim
         log(import_id, f"Status code {e.response.status_code} when contacting DM message API.", 'exception')
         raise
 
+    existing_dm_ids = get_existing_dm_ids('patreon', [
+        (message['user']['user_id'], str(message['message_id']), message['message'])
+        for message in scraper_data['messages'] if message['type'] == 'MESG'
+    ])
+    dms_writer = PageWriter('unapproved_dms', update = False, import_id = import_id)
     for message in scraper_data['messages']:
         # https://sendbird.com/docs/chat/v3/platform-api/guides/messages
         dm_id = str(message['message_id'])
@@ -515,7 +531,7 @@ def import_channel(auth_token, url, import_id, current_user, contributor_id, tim
         log(import_id, f"Starting message import: {dm_id} from user {user_id}", to_client = False)
 
         if (message['type'] == 'MESG'):
-            if dm_exists('patreon', user_id, dm_id, message['message']):
+            if dm_id in existing_dm_ids:
                 log(import_id, f"Skipping message {dm_id} from user {user_id} because already exists", to_client = False)
                 continue
             
@@ -543,26 +559,14 @@ def import_channel(auth_token, url, import_id, current_user, contributor_id, tim
             post_model['embed'] = json.dumps(post_model['embed'])
             post_model['file'] = json.dumps(post_model['file'])
 
-            columns = post_model.keys()
-            data = ['%s'] * len(post_model.values())
-            query = "INSERT INTO unapproved_dms ({fields}) VALUES ({values}) ON CONFLICT DO NOTHING".format(
-                fields = ','.join(columns),
-                values = ','.join(data)
-            )
-            conn = get_raw_conn()
-            try:
-                cursor = conn.cursor()
-                cursor.execute(query, list(post_model.values()))
-                conn.commit()
-            finally:
-                return_conn(conn)
-            
-            if (config.ban_url):
-                requests.request('BAN', f"{config.ban_url}/{post_model['service']}/user/" + user_id + "/dms")
-            delete_dm_cache_keys(post_model['service'], user_id)
+            dms_writer.add(post_model, after = [
+                *([(requests.request, 'BAN', f"{config.ban_url}/{post_model['service']}/user/" + user_id + "/dms")] if config.ban_url else []),
+                (delete_dm_cache_keys, post_model['service'], user_id)
+            ])
         elif (message['type'] == 'FILE'):
             log(import_id, f'Skipping message {dm_id} because file DMs are unsupported', to_client=True)
             continue
+    dms_writer.flush()
     
     if (scraper_data['messages']):
         import_channel(auth_token, url, import_id, current_user, contributor_id, timestamp = scraper_data['messages'][0]['created_at'])
@@ -597,7 +601,7 @@ def import_dms(key, import_id, contributor_id):
 
     import_channels(ws_data['key'], current_user_id, get_dm_campaigns(key, current_user_id, import_id), import_id, contributor_id)
 
-def import_comment(comment, user_id, import_id):
+def import_comment(comment, user_id, import_id, comments_writer):
     post_id = comment['relationships']['post']['data']['id']
     commenter_id = comment['relationships']['commenter']['data']['id']
     comment_id = comment['id']
@@ -619,23 +623,10 @@ def import_comment(comment, user_id, import_id):
         'published': comment['attributes']['created'],
     }
 
-    columns = post_model.keys()
-    data = ['%s'] * len(post_model.values())
-    query = "INSERT INTO comments ({fields}) VALUES ({values}) ON CONFLICT DO NOTHING".format(
-        fields = ','.join(columns),
-        values = ','.join(data)
-    )
-    conn = get_raw_conn()
-    try:
-        cursor = conn.cursor()
-        cursor.execute(query, list(post_model.values()))
-        conn.commit()
-    finally:
-        return_conn(conn)
-
-    if (config.ban_url):
-        requests.request('BAN', f"{config.ban_url}/{post_model['service']}/user/" + user_id + '/post/' + post_model['post_id'])
-    delete_comment_cache_keys(post_model['service'], user_id, post_model['post_id'])
+    comments_writer.add(post_model, after = [
+        *([(requests.request, 'BAN', f"{config.ban_url}/{post_model['service']}/user/" + user_id + '/post/' + post_model['post_id'])] if config.ban_url else []),
+        (delete_comment_cache_keys, post_model['service'], user_id, post_model['post_id'])
+    ])
 
 def import_comments(url, key, post_id, user_id, import_id):
     try:
@@ -649,16 +640,16 @@ def import_comments(url, key, post_id, user_id, import_id):
         log(import_id, 'Error connecting to cloudscraper. Please try again.', 'exception')
         return
     
-    all_comments = get_comments_for_posts('patreon', post_id)
+    comments_writer = PageWriter('comments', ['id', 'service'], update = False, import_id = import_id)
     while True:
+        existing_comment_ids = get_existing_comment_ids('patreon', [comment['id'] for comment in scraper_data['data']] + [included['id'] for included in scraper_data.get('included', []) if included['type'] == 'comment'])
         for comment in scraper_data['data']:
             comment_id = comment['id']
-            commenter_id = comment['relationships']['commenter']['data']['id']
             try:
-                if len(list(filter(lambda comment: comment['id'] == post_id and comment['commenter'] == commenter_id, all_comments))) > 0:
+                if comment_id in existing_comment_ids:
                     log(import_id, f"Skipping comment {comment_id} from post {post_id} because already exists", to_client = False)
                     continue
-                import_comment(comment, user_id, import_id)
+                import_comment(comment, user_id, import_id, comments_writer)
             except Exception as e:
                 log(import_id, f"Error while importing comment {comment_id} from post {post_id}", 'exception', True)
                 continue
@@ -666,17 +657,17 @@ def import_comments(url, key, post_id, user_id, import_id):
         if scraper_data.get('included'):
             for included in scraper_data['included']:
                 if (included['type'] == 'comment'):
-                    comment_id = comment['id']
-                    commenter_id = comment['relationships']['commenter']['data']['id']
+                    comment_id = included['id']
                     try:
-                        if len(list(filter(lambda comment: comment['id'] == post_id and comment['commenter'] == commenter_id, all_comments))) > 0:
+                        if comment_id in existing_comment_ids:
                             log(import_id, f"Skipping comment {comment_id} from post {post_id} because already exists", to_client = False)
                             continue
-                        import_comment(included, user_id, import_id)
+                        import_comment(included, user_id, import_id, comments_writer)
                     except Exception as e:
                         log(import_id, f"Error while importing comment {comment_id} from post {post_id}", 'exception', True)
                         continue
         
+        comments_writer.flush()
         if 'links' in scraper_data and 'next' in scraper_data['links']:
             log(import_id, f"Processing next page of comments for post {post_id}", to_client = False)
             try:
@@ -715,17 +706,17 @@ def import_campaign_page(url, key, import_id, contributor_id = None, allowed_to_
         except:
             log(import_id, f"An error occured while saving your key for auto-import.", 'exception')
     
-    dnp = get_all_dnp()
-    post_ids_of_users = {}
-    flagged_post_ids_of_users = {}
+    existing_posts = PostExistenceIndex('patreon', import_id)
+    posts_writer = PageWriter('posts', ['id', 'service'], casts = { 'attachments': 'jsonb[]' }, import_id = import_id)
     while True:
         for post in scraper_data['data']:
             try:
                 user_id = post['relationships']['user']['data']['id']
                 post_id = post['id']
 
-                if len(list(filter(lambda artist: artist['id'] == user_id and artist['service'] == 'patreon', dnp))) > 0:
+                if is_dnp('patreon', user_id):
                     log(import_id, f"Skipping user {user_id} because they are in do not post list", to_client = True)
+                    posts_writer.flush()
                     return
 
                 if not post['attributes']['current_user_can_view']:
@@ -735,11 +726,7 @@ def import_campaign_page(url, key, import_id, contributor_id = None, allowed_to_
                 import_comments(comments_url.format(post_id), key, post_id, user_id, import_id)
 
                 # existence checking
-                if not post_ids_of_users.get(user_id):
-                    post_ids_of_users[user_id] = get_all_artist_post_ids('patreon', user_id)
-                if not flagged_post_ids_of_users.get(user_id):
-                    flagged_post_ids_of_users[user_id] = get_all_artist_flagged_post_ids('patreon', user_id)
-                if len(list(filter(lambda post: post['id'] == post_id, post_ids_of_users[user_id]))) > 0 and len(list(filter(lambda flag: flag['id'] == post_id, flagged_post_ids_of_users[user_id]))) == 0:
+                if existing_posts.should_skip(user_id, post_id):
                     log(import_id, f'Skipping post {post_id} from user {user_id} because already exists', to_client = True)
                     continue
                 log(import_id, f"Starting import: {post_id} from user {user_id}")
@@ -759,6 +746,12 @@ def import_campaign_page(url, key, import_id, contributor_id = None, allowed_to_
                     'attachments': []
                 }
 
+                # all files of the post are collected first and downloaded together
+                inline_urls = []
+                inline_jobs = []
+                file_jobs = []
+                attachment_jobs = []
+
                 if post['attributes']['content']:
                     post_model['content'] = post['attributes']['content']
                     for image in text.extract_iter(post['attributes']['content'], '<img data-media-id="', '>'):
@@ -766,15 +759,8 @@ def import_campaign_page(url, key, import_id, contributor_id = None, allowed_to_
                         path = urlparse(download_url).path
                         ext = splitext(path)[1]
                         fn = str(uuid.uuid4()) + ext
-                        _, hash_filename, _ = download_file(
-                            download_url,
-                            'patreon',
-                            user_id,
-                            post_id,
-                            name = fn,
-                            inline = True
-                        )
-                        post_model['content'] = post_model['content'].replace(download_url, hash_filename)
+                        inline_urls.append(download_url)
+                        inline_jobs.append(((download_url, 'patreon', user_id, post_id), { 'name': fn, 'inline': True }))
 
                 if post['attributes']['embed']:
                     post_model['embed']['subject'] = post['attributes']['embed']['subject']
@@ -782,95 +768,59 @@ def import_campaign_page(url, key, import_id, contributor_id = None, allowed_to_
                     post_model['embed']['url'] = post['attributes']['embed']['url']
 
                 if post['attributes']['post_file']:
-                    reported_filename, hash_filename, _ = download_file(
-                        post['attributes']['post_file']['url'],
-                        'patreon',
-                        user_id,
-                        post_id,
-                        name = post['attributes']['post_file']['name']
-                    )
-                    post_model['file']['name'] = reported_filename
-                    post_model['file']['path'] = hash_filename
+                    file_jobs.append(((post['attributes']['post_file']['url'], 'patreon', user_id, post_id), { 'name': post['attributes']['post_file']['name'] }))
 
                 for attachment in post['relationships']['attachments']['data']:
-                    reported_filename, hash_filename, _ = download_file(
-                        f"https://www.patreon.com/file?h={post_id}&i={attachment['id']}",
-                        'patreon',
-                        user_id,
-                        post_id,
-                        cookies = { 'session_id': key }
-                    )
-                    post_model['attachments'].append({
-                        'name': reported_filename,
-                        'path': hash_filename
-                    })
+                    attachment_jobs.append(((f"https://www.patreon.com/file?h={post_id}&i={attachment['id']}", 'patreon', user_id, post_id), { 'cookies': { 'session_id': key } }))
 
                 if post['relationships']['images']['data']:
                     for image in post['relationships']['images']['data']:
                         for media in list(filter(lambda included: included['id'] == image['id'], scraper_data['included'])):
                             if media['attributes']['state'] != 'ready':
                                 continue
-                            reported_filename, hash_filename, _ = download_file(
-                                media['attributes']['download_url'],
-                                'patreon',
-                                user_id,
-                                post_id,
-                                name = media['attributes']['file_name']
-                            )
-                            post_model['attachments'].append({
-                                'name': reported_filename,
-                                'path': hash_filename
-                            })
+                            attachment_jobs.append(((media['attributes']['download_url'], 'patreon', user_id, post_id), { 'name': media['attributes']['file_name'] }))
 
                 if post['relationships']['audio']['data']:
                     for media in list(filter(lambda included: included['id'] == post['relationships']['audio']['data']['id'], scraper_data['included'])):
                         if media['attributes']['state'] != 'ready':
                             continue
-                        reported_filename, hash_filename, _ = download_file(
-                            media['attributes']['download_url'],
-                            'patreon',
-                            user_id,
-                            post_id,
-                            name = media['attributes']['file_name']
-                        )
-                        post_model['attachments'].append({
-                            'name': reported_filename,
-                            'path': hash_filename
-                        })
+                        attachment_jobs.append(((media['attributes']['download_url'], 'patreon', user_id, post_id), { 'name': media['attributes']['file_name'] }))
+
+                results = download_files(inline_jobs + file_jobs + attachment_jobs)
+                inline_results = results[:len(inline_jobs)]
+                file_results = results[len(inline_jobs):len(inline_jobs) + len(file_jobs)]
+                attachment_results = results[len(inline_jobs) + len(file_jobs):]
+
+                for download_url, (_, hash_filename, _) in zip(inline_urls, inline_results):
+                    post_model['content'] = post_model['content'].replace(download_url, hash_filename)
+
+                for reported_filename, hash_filename, _ in file_results:
+                    post_model['file']['name'] = reported_filename
+                    post_model['file']['path'] = hash_filename
+
+                for reported_filename, hash_filename, _ in attachment_results:
+                    post_model['attachments'].append({
+                        'name': reported_filename,
+                        'path': hash_filename
+                    })
 
                 post_model['embed'] = json.dumps(post_model['embed'])
                 post_model['file'] = json.dumps(post_model['file'])
                 for i in range(len(post_model['attachments'])):
                     post_model['attachments'][i] = json.dumps(post_model['attachments'][i])
 
-                columns = post_model.keys()
-                data = ['%s'] * len(post_model.values())
-                data[-1] = '%s::jsonb[]' # attachments
-                query = "INSERT INTO posts ({fields}) VALUES ({values}) ON CONFLICT (id, service) DO UPDATE SET {updates}".format(
-                    fields = ','.join(columns),
-                    values = ','.join(data),
-                    updates = ','.join([f'{column}=EXCLUDED.{column}' for column in columns])
-                )
-                conn = get_raw_conn()
-                try:
-                    cursor = conn.cursor()
-                    cursor.execute(query, list(post_model.values()))
-                    conn.commit()
-                finally:
-                    return_conn(conn)
-
-                update_artist('patreon', user_id)
-                delete_post_flags('patreon', user_id, post_id)
-
-                if (config.ban_url):
-                    requests.request('BAN', f"{config.ban_url}/{post_model['service']}/user/" + post_model['"user"'])
-                delete_artist_cache_keys('patreon', user_id)
-
-                log(import_id, f"Finished importing {post_id} from user {user_id}", to_client=False)
+                posts_writer.add(post_model, after = [
+                    (update_artist, 'patreon', user_id),
+                    (delete_post_flags, 'patreon', user_id, post_id),
+                    *([(requests.request, 'BAN', f"{config.ban_url}/{post_model['service']}/user/" + post_model['"user"'])] if config.ban_url else []),
+                    (delete_artist_cache_keys, 'patreon', user_id),
+                    (log, import_id, f"Finished importing {post_id} from user {user_id}", 'debug', False)
+                ])
             except Exception as e:
                 log(import_id, f"Error while importing {post_id} from user {user_id}", 'exception', True)
                 continue
             
+        posts_writer.flush()
         if 'links' in scraper_data and 'next' in scraper_data['links']:
             log(import_id, f'Finished processing page. Processing next page.')
             try:
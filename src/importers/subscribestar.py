@@ -14,9 +14,12 @@ import dateparser
 
 from flask import current_app
 
-from ..internals.database.database import get_conn, get_raw_conn, return_conn
-from ..lib.artist import index_artists, is_artist_dnp, update_artist, delete_artist_cache_keys, get_all_artist_post_ids, get_all_artist_flagged_post_ids, get_all_dnp
-from ..lib.post import post_flagged, post_exists, delete_post_flags, move_to_backup, restore_from_backup, delete_backup
+from ..internals.database.database import get_conn
+from ..lib.artist import index_artists, update_artist, delete_artist_cache_keys
+from ..lib.existence_index import PostExistenceIndex
+from ..lib.dnp import is_dnp
+from ..lib.page_writer import PageWriter
+from ..lib.post import delete_post_flags
 from ..lib.autoimport import encrypt_and_save_session_for_auto_import, kill_key
 from ..internals.utils.download import download_file, DownloaderException
 from ..internals.utils.scrapper import create_scrapper_session
@@ -61,9 +64,8 @@ def import_posts(import_id, key, contributor_id, allowed_to_auto_import, key_id)
         return #break early as there's nothing anyway
     
     first_run = True
-    dnp = get_all_dnp()
-    post_ids_of_users = {}
-    flagged_post_ids_of_users = {}
+    existing_posts = PostExistenceIndex('subscribestar', import_id)
+    posts_writer = PageWriter('posts', ['id', 'service'], casts = { 'attachments': 'jsonb[]' }, import_id = import_id)
     while True:
         soup = BeautifulSoup(scraper_data, 'html.parser')
         posts = soup.find_all("div", {"class": "post"})
@@ -88,16 +90,12 @@ def import_posts(import_id, key, contributor_id, allowed_to_auto_import, key_id)
                     log(import_id, f"Skipping post {post_id} from user {user_id} as tier is too high")
                     continue
 
-                if len(list(filter(lambda artist: artist['id'] == user_id and artist['service'] == 'subscribestar', dnp))) > 0:
+                if is_dnp('subscribestar', user_id):
                     log(import_id, f"Skipping post {post_id} from user {user_id} is in do not post list")
                     continue
 
                 # existence checking
-                if not post_ids_of_users.get(user_id):
-                    post_ids_of_users[user_id] = get_all_artist_post_ids('subscribestar', user_id)
-                if not flagged_post_ids_of_users.get(user_id):
-                    flagged_post_ids_of_users[user_id] = get_all_artist_flagged_post_ids('subscribestar', user_id)
-                if len(list(filter(lambda post: post['id'] == post_id, post_ids_of_users[user_id]))) > 0 and len(list(filter(lambda flag: flag['id'] == post_id, flagged_post_ids_of_users[user_id]))) == 0:
+                if existing_posts.should_skip(user_id, post_id):
                     log(import_id, f'Skipping post {post_id} from user {user_id} because already exists', to_client = True)
                     continue
 
@@ -176,36 +174,20 @@ def import_posts(import_id, key, contributor_id, allowed_to_auto_import, key_id)
                 post_model['embed'] = json.dumps(post_model['embed'])
                 post_model['file'] = json.dumps(post_model['file'])
 
-                columns = post_model.keys()
-                data = ['%s'] * len(post_model.values())
-                data[-1] = '%s::jsonb[]' # attachments
-                query = "INSERT INTO posts ({fields}) VALUES ({values}) ON CONFLICT (id, service) DO UPDATE SET {updates}".format(
-                    fields = ','.join(columns),
-                    values = ','.join(data),
-                    updates = ','.join([f'{column}=EXCLUDED.{column}' for column in columns])
-                )
-                conn = get_raw_conn()
-                try:
-                    cursor3 = conn.cursor()
-                    cursor3.execute(query, list(post_model.values()))
-                    conn.commit()
-                finally:
-                    return_conn(conn)
-
-                update_artist('subscribestar', user_id)
-                delete_post_flags('subscribestar', user_id, str(post_id))
-
-                if (config.ban_url):
-                    requests.request('BAN', f"{config.ban_url}/{post_model['service']}/user/" + post_model['"user"'])
-                delete_artist_cache_keys('subscribestar', user_id)
-
-                log(import_id, f"Finished importing {post_id} from user {user_id}", to_client = False)
+                posts_writer.add(post_model, after = [
+                    (update_artist, 'subscribestar', user_id),
+                    (delete_post_flags, 'subscribestar', user_id, str(post_id)),
+                    *([(requests.request, 'BAN', f"{config.ban_url}/{post_model['service']}/user/" + post_model['"user"'])] if config.ban_url else []),
+                    (delete_artist_cache_keys, 'subscribestar', user_id),
+                    (log, import_id, f"Finished importing {post_id} from user {user_id}", 'debug', False)
+                ])
 
 
             except Exception:
                 log(import_id, f"Error while importing {post_id} from user {user_id}", 'exception')
                 continue
         
+        posts_writer.flush()
         more = soup.find("div", {"class": "posts-more"})
         
         if more: #we get the next HTML ready, and it'll process the new
@@ -0,0 +1,10 @@
+import config
+from yoyo import read_migrations
+from yoyo import get_backend
+
+def apply():
+    backend = get_backend(f'postgres://{config.database_user}:{config.database_password}@{config.database_host}/{config.database_dbname}')
+    migrations = read_migrations('./migrations')
+    # the lock keeps the web app and workers starting at the same time from applying them twice
+    with backend.lock():
+        backend.apply_migrations(backend.to_apply(migrations))
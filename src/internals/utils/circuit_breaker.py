@@ -0,0 +1,84 @@
+import config
+import time
+from threading import Lock
+from requests.exceptions import RequestException
+from .upstreams import get_upstream
+
+# consecutive failed requests (connection errors, timeouts, 5xx) that open the circuit of an upstream
+failure_threshold = getattr(config, 'circuit_breaker_threshold', 20)
+# how long an open circuit fails requests before letting probes through
+reset_seconds = getattr(config, 'circuit_breaker_reset_seconds', 60)
+# requests let through at once while half-open; the first to succeed closes the circuit
+half_open_probes = getattr(config, 'circuit_breaker_probes', 1)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+class CircuitOpenException(RequestException):
+    pass
+
+class Circuit:
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probes = 0
+        self.rejected = 0
+        self.lock = Lock()
+
+    def before_request(self, upstream):
+        with self.lock:
+            # probes that never reported back are given up on after another reset period
+            if self.state != CLOSED and time.monotonic() - self.opened_at >= reset_seconds:
+                self.state = HALF_OPEN
+                self.opened_at = time.monotonic()
+                self.probes = 0
+            if self.state == CLOSED:
+                return
+            if self.state == HALF_OPEN and self.probes < half_open_probes:
+                self.probes += 1
+                return
+            self.rejected += 1
+        raise CircuitOpenException(f'Circuit for {upstream} is open; not sending request')
+
+    def record(self, success):
+        with self.lock:
+            if success:
+                self.state = CLOSED
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= failure_threshold:
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+circuits = {}
+circuits_lock = Lock()
+
+def get_circuit(upstream):
+    with circuits_lock:
+        if upstream not in circuits:
+            circuits[upstream] = Circuit()
+        return circuits[upstream]
+
+def before_request(url):
+    """
+    Raises `CircuitOpenException` when requests to the upstream of `url` are currently failing fast.
+    """
+    upstream = get_upstream(url)
+    get_circuit(upstream).before_request(upstream)
+
+def record_result(url, success):
+    get_circuit(get_upstream(url)).record(success)
+
+def get_circuit_states():
+    with circuits_lock:
+        return {
+            upstream: {
+                'state': circuit.state,
+                'failures': circuit.failures,
+                'open_for': max(0, reset_seconds - (time.monotonic() - circuit.opened_at)) if circuit.state == OPEN else 0,
+                'rejected': circuit.rejected
+            } for upstream, circuit in circuits.items()
+        }
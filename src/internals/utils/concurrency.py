@@ -0,0 +1,143 @@
+import config
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+from threading import Lock, Condition
+from .upstreams import get_upstream
+
+# requests allowed in flight per upstream; the limit grows by one per window of successful requests
+# and is cut by `adaptive_concurrency_decrease` whenever the upstream pushes back (429/503)
+initial_limit = getattr(config, 'adaptive_concurrency_initial', 4)
+min_limit = getattr(config, 'adaptive_concurrency_min', 1)
+max_limit = getattr(config, 'adaptive_concurrency_max', 32)
+decrease_factor = getattr(config, 'adaptive_concurrency_decrease', 0.5)
+# the limit stops growing while latency is this many times over the best seen, as the upstream is queueing us
+latency_tolerance = getattr(config, 'adaptive_concurrency_latency_tolerance', 2.0)
+# pushback seen within this many seconds (or the average latency, if longer) of a cut doesn't cut the limit again,
+# as a burst of requests in flight together answered by 429s is one signal, not one per response
+decrease_cooldown = getattr(config, 'adaptive_concurrency_cooldown', 1.0)
+
+backoff_statuses = (429, 503)
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def is_route_limit(headers):
+    # discord answers 429 for a single route's bucket unless the global limit was hit
+    return 'x-ratelimit-bucket' in headers and headers.get('x-ratelimit-global', '').lower() != 'true'
+
+def get_pause(status, headers):
+    """
+    Returns how many seconds the upstream asked us to hold off for, if it did.
+    """
+    if status in backoff_statuses and not is_route_limit(headers):
+        return parse_retry_after(headers.get('retry-after'))
+    return None
+
+def get_route_pause(status, headers):
+    """
+    Returns how many seconds requests to the same route have to wait, if the upstream said so.
+    """
+    if status in backoff_statuses and is_route_limit(headers):
+        return parse_retry_after(headers.get('retry-after'))
+    # discord tells us the state of the route's bucket on every response
+    if headers.get('x-ratelimit-remaining') == '0':
+        return parse_retry_after(headers.get('x-ratelimit-reset-after'))
+    return None
+
+def get_route(url):
+    parsed = urlparse(url)
+    return f'{parsed.hostname}{parsed.path}'
+
+class AdaptiveLimiter:
+    def __init__(self):
+        self.limit = float(initial_limit)
+        self.in_flight = 0
+        self.paused_until = 0
+        self.decreased_at = None
+        # pauses that only hold back requests to one route, keyed by `get_route`
+        self.route_pauses = {}
+        self.latency = None
+        self.min_latency = None
+        self.backoffs = 0
+        self.condition = Condition()
+
+    def acquire(self, route=None):
+        with self.condition:
+            while True:
+                pause = max(self.paused_until, self.route_pauses.get(route, 0)) - time.monotonic()
+                if pause > 0:
+                    self.condition.wait(pause)
+                elif self.in_flight >= int(self.limit):
+                    self.condition.wait()
+                else:
+                    break
+            self.in_flight += 1
+
+    def release(self, status=None, headers=None, latency=None, route=None):
+        with self.condition:
+            self.in_flight -= 1
+            self.update(status, headers, latency, route)
+            self.condition.notify_all()
+
+    def update(self, status, headers, latency, route=None):
+        now = time.monotonic()
+        headers = headers or {}
+        pause = get_pause(status, headers)
+        if pause:
+            self.paused_until = max(self.paused_until, now + pause)
+        route_pause = get_route_pause(status, headers)
+        if route_pause and route is not None:
+            self.route_pauses = { key: until for key, until in self.route_pauses.items() if until > now }
+            self.route_pauses[route] = max(self.route_pauses.get(route, 0), now + route_pause)
+        if status in backoff_statuses:
+            self.backoffs += 1
+            if self.decreased_at is None or now - self.decreased_at >= max(decrease_cooldown, self.latency or 0):
+                self.limit = max(min_limit, self.limit * decrease_factor)
+                self.decreased_at = now
+            return
+        if status is None or latency is None:
+            return
+        self.latency = latency if self.latency is None else self.latency * 0.9 + latency * 0.1
+        self.min_latency = latency if self.min_latency is None else min(self.min_latency, latency)
+        if self.latency <= self.min_latency * latency_tolerance:
+            self.limit = min(max_limit, self.limit + 1 / self.limit)
+
+    def backoff(self, status, headers, route=None):
+        """
+        Records a response that was retried before reaching the caller.
+        """
+        with self.condition:
+            self.update(status, headers, None, route)
+
+limiters = {}
+limiters_lock = Lock()
+
+def get_limiter(url):
+    upstream = get_upstream(url)
+    with limiters_lock:
+        if upstream not in limiters:
+            limiters[upstream] = AdaptiveLimiter()
+        return limiters[upstream]
+
+def get_concurrency_stats():
+    with limiters_lock:
+        return {
+            upstream: {
+                'limit': int(limiter.limit),
+                'in_flight': limiter.in_flight,
+                'paused_for': max(0, limiter.paused_until - time.monotonic()),
+                'paused_routes': sum(1 for until in list(limiter.route_pauses.values()) if until > time.monotonic()),
+                'latency': limiter.latency,
+                'backoffs': limiter.backoffs
+            } for upstream, limiter in limiters.items()
+        }
@@ -11,20 +11,26 @@ import tempfile
 import os
 import magic
 import re
-import pathlib
 import datetime
-from PIL import Image
+import hashlib
 from os import rename, makedirs, remove
-from os.path import join, getsize, exists, splitext, basename, dirname
+from os.path import join, getsize, exists, splitext, basename
 from .proxy import get_proxy
-from .utils import get_hash_of_file
-from ...lib.files import write_file_log
+from .session_pool import get_session
+from .thumbnail import enqueue_thumbnail
+from .circuit_breaker import CircuitOpenException
+from ...lib.files import write_file_log, normalize_remote_path, get_file_by_remote_path
 
 non_url_safe = ['"', '#', '$', '%', '&', '+',
     ',', '/', ':', ';', '=', '?',
     '@', '[', '\\', ']', '^', '`',
     '{', '|', '}', '~', "'"]
 
+# bytes read from the response per iteration while streaming to disk
+chunk_size = 1024 * 1024
+# how much of the start of the body is kept for mime sniffing
+mime_sniff_size = 8192
+
 class DuplicateException(Exception):
     pass
 
@@ -69,13 +75,59 @@ def slugify(text):
     text = u'_'.join(text.split())
     return text
 
+class PartialDownload:
+    """
+    Progress of a download that survives failed attempts,
+    so the next attempt can resume from where the previous one stopped.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.hasher = hashlib.sha256()
+        self.size = 0
+        self.head = b''
+        # strong etag or last-modified date sent back in `If-Range`; None when the server can't resume
+        self.validator = None
+
+    def write(self, file, chunk):
+        file.write(chunk)
+        self.hasher.update(chunk)
+        if len(self.head) < mime_sniff_size:
+            self.head += chunk[:mime_sniff_size - len(self.head)]
+        self.size += len(chunk)
+
+    def range_headers(self):
+        if self.size == 0 or self.validator is None:
+            return {}
+        return {
+            'Range': f'bytes={self.size}-',
+            'If-Range': self.validator
+        }
+
+def get_resume_validator(r):
+    # ranges of encoded bodies don't line up with the decoded bytes we keep
+    if r.headers.get('accept-ranges', '').lower() != 'bytes' or r.headers.get('content-encoding', 'identity') != 'identity':
+        return None
+    etag = r.headers.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return r.headers.get('last-modified')
+
+def stream_to_file(r, file, partial):
+    """
+    Writes the response body to `file` chunk by chunk, recording the hash, size and head of the body in `partial`.
+    """
+    for chunk in iter(lambda: r.raw.read(chunk_size), b''):
+        partial.write(file, chunk)
+
 def download_branding(ddir, url, name = None, **kwargs):
     temp_name = str(uuid.uuid4()) + '.temp'
     tries = 10
     makedirs(ddir, exist_ok=True)
     for i in range(tries):
         try:
-            r = requests.get(url, stream = True, proxies=get_proxy(), **kwargs)
+            r = get_session('download').get(url, stream = True, proxies=get_proxy(), **kwargs)
             r.raw.read = functools.partial(r.raw.read, decode_content=True)
             r.raise_for_status()
             # Should retry on connection error
@@ -100,10 +152,10 @@ def download_branding(ddir, url, name = None, **kwargs):
                 file.close()
                 rename(join(ddir, temp_name), join(ddir, filename))
                 
-                make_thumbnail(join(ddir, filename))
+                enqueue_thumbnail(join(ddir, filename))
 
                 return filename, r
-        except requests.HTTPError as e:
+        except (requests.HTTPError, CircuitOpenException) as e:
             raise e
         except:
             if i < tries - 1: # i is zero indexed
@@ -123,23 +175,75 @@ def download_file(
     discord_message_server: str = '',
     discord_message_channel: str = '',
     discord_message_id: str = '',
+    file_log = None,
     **kwargs
 ):
+    # urls we have already downloaded from are only linked to the post
+    remote_path = normalize_remote_path(url)
+    # entries go to `file_log` (a `FileLogBatch`) when one is given, and straight to the database otherwise
+    log_file = file_log.add if file_log else write_file_log
+    known_file = get_file_by_remote_path(remote_path)
+    if known_file:
+        hash_filename = join(known_file['hash'][0:2], known_file['hash'][2:4], known_file['hash'] + known_file['ext'])
+        if exists(join(config.download_path, 'data', hash_filename)):
+            reported_filename = name or known_file['filename'] or (known_file['hash'] + known_file['ext'])
+            log_file(
+                fhash=known_file['hash'],
+                mtime=known_file['mtime'],
+                ctime=known_file['ctime'],
+                mime=known_file['mime'],
+                ext=known_file['ext'],
+                filename=reported_filename,
+                service=service,
+                user=user,
+                post=post,
+                inline=inline,
+                remote_path=remote_path,
+                discord=discord,
+                discord_message_server=discord_message_server,
+                discord_message_channel=discord_message_channel,
+                discord_message_id=discord_message_id
+            )
+            return reported_filename, '/' + hash_filename, None
+
     makedirs(join(config.download_path, 'data', 'tmp'), exist_ok=True)
     temp_dir = tempfile.mkdtemp(dir=join(config.download_path, 'data', 'tmp'))
     temp_name = str(uuid.uuid4()) + '.temp'
+    headers = kwargs.pop('headers', None) or {}
+    # the temp file is kept between attempts, and resumed with a range request when the server allows it
+    partial = PartialDownload()
     tries = 10
     for i in range(tries):
         try:
-            r = requests.get(url, stream = True, proxies=get_proxy(), **kwargs)
+            r = get_session('download').get(url, stream = True, proxies=get_proxy(), headers={ **headers, **partial.range_headers() }, **kwargs)
             r.raw.read = functools.partial(r.raw.read, decode_content=True)
+            if r.status_code == 416:
+                # the body is never read, so hand the connection back to the pool
+                r.close()
+                partial.reset()
+                raise DownloaderException('Requested range not satisfiable; restarting download')
             r.raise_for_status()
+            if r.status_code == 206:
+                resumed_from = re.match(r'bytes (\d+)-', r.headers.get('content-range', ''))
+                if not resumed_from or int(resumed_from.group(1)) != partial.size:
+                    r.close()
+                    requested_from = partial.size
+                    partial.reset()
+                    raise DownloaderException(f'Server did not resume from byte {requested_from}; restarting download')
+            else:
+                # the whole file was sent, either because this is the first attempt or the file changed upstream
+                partial.reset()
+                partial.validator = get_resume_validator(r)
             # Should retry on connection error
-            with open(join(temp_dir, temp_name), 'wb+') as file:
-                shutil.copyfileobj(r.raw, file)
+            with open(join(temp_dir, temp_name), 'r+b' if partial.size else 'wb') as file:
+                file.seek(partial.size)
+                file.truncate()
+                # hash, size and mime are computed while the body streams in,
+                # so the file is written once and never read back
+                stream_to_file(r, file, partial)
                 # filename guessing
-                reported_mime, _ = cgi.parse_header(r.headers['content-type']) if r.headers.get('content-type') else None
-                mime = magic.from_file(join(temp_dir, temp_name), mime=True)
+                reported_mime, _ = cgi.parse_header(r.headers['content-type']) if r.headers.get('content-type') else (None, None)
+                mime = magic.from_buffer(partial.head, mime=True)
                 extension = re.sub('^.jpe$', '.jpg', mimetypes.guess_extension(mime or reported_mime or 'application/octet-stream', strict=False) or '.bin')
                 reported_filename = name or r.headers.get('x-amz-meta-original-filename') or get_filename_from_cd(r.headers.get('content-disposition')) or (str(uuid.uuid4()) + extension)
                 
@@ -148,27 +252,32 @@ def download_file(
                     reported_size = r.raw.tell()
                     downloaded_size = r.headers.get('content-length')
                     raise DownloaderException(f'Downloaded size is less than reported; {downloaded_size} < {reported_size}')
+                # the hash covers every attempt, so make sure the pieces add up to the whole file
+                total_size = r.headers.get('content-range', '').rpartition('/')[2]
+                if r.status_code == 206 and total_size.isdigit() and partial.size != int(total_size):
+                    raise DownloaderException(f'Resumed file size does not match reported; {partial.size} != {total_size}')
 
                 # generate hashy filename
                 # this will be the one we actually save the file with
-                file_hash = get_hash_of_file(join(temp_dir, temp_name))
+                file_hash = partial.hasher.hexdigest()
                 hash_filename = join(file_hash[0:2], file_hash[2:4], file_hash + extension)
 
-                fname = pathlib.Path(join(temp_dir, temp_name))
-                mtime = datetime.datetime.fromtimestamp(fname.stat().st_mtime)
-                ctime = datetime.datetime.fromtimestamp(fname.stat().st_ctime)
-                write_file_log(
-                    file_hash,
-                    mtime,
-                    ctime,
-                    mime,
-                    extension,
-                    reported_filename,
-                    service,
-                    user,
-                    post,
-                    inline,
-                    url,
+                file.flush()
+                stat = os.fstat(file.fileno())
+                mtime = datetime.datetime.fromtimestamp(stat.st_mtime)
+                ctime = datetime.datetime.fromtimestamp(stat.st_ctime)
+                log_file(
+                    fhash=file_hash,
+                    mtime=mtime,
+                    ctime=ctime,
+                    mime=mime,
+                    ext=extension,
+                    filename=reported_filename,
+                    service=service,
+                    user=user,
+                    post=post,
+                    inline=inline,
+                    remote_path=remote_path,
                     discord=discord,
                     discord_message_server=discord_message_server,
                     discord_message_channel=discord_message_channel,
@@ -184,23 +293,16 @@ def download_file(
                 makedirs(join(config.download_path, 'data', file_hash[0:2], file_hash[2:4]), exist_ok=True)
                 rename(join(temp_dir, temp_name), join(config.download_path, 'data', hash_filename))
                 shutil.rmtree(temp_dir, ignore_errors=True)
-                make_thumbnail(join(config.download_path, 'data', hash_filename))
+                enqueue_thumbnail(join(config.download_path, 'data', hash_filename))
                 return reported_filename, '/' + hash_filename, r
-        except requests.HTTPError as e:
+        # retrying against an upstream that is down only adds to the pile of stuck imports
+        except (requests.HTTPError, CircuitOpenException) as e:
+            shutil.rmtree(temp_dir, ignore_errors=True)
             raise e
         except:
             if i < tries - 1: # i is zero indexed
                 continue
             else:
+                shutil.rmtree(temp_dir, ignore_errors=True)
                 raise
         break
-
-def make_thumbnail(path):
-    try:
-        image = Image.open(path)
-        image = image.convert('RGB')
-        image.thumbnail((800, 800))
-        makedirs(dirname(join(config.download_path, 'thumbnail' + path.replace(config.download_path, ''))), exist_ok=True)
-        image.save(join(config.download_path, 'thumbnail' + path.replace(config.download_path, '')), 'JPEG', quality=60)
-    except:
-        pass
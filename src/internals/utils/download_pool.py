@@ -0,0 +1,93 @@
+import config
+from threading import Lock
+from collections import deque, OrderedDict
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, Future
+from .download import download_file
+from ...lib.files import FileLogBatch
+
+# total number of downloads running at once across all imports
+max_workers = getattr(config, 'download_workers', 32)
+# downloads allowed to hit the same host at once, shared by every import in the process;
+# imports take turns for them, so a large import slows the others down rather than holding them up
+max_per_host = getattr(config, 'download_workers_per_host', 4)
+
+executor = None
+executor_lock = Lock()
+# downloads wait here for their host to have room, so they don't take up executor workers while they wait;
+# host -> batch (one `download_files` call) -> downloads, the batches being served in turn
+host_queues = {}
+host_running = {}
+hosts_lock = Lock()
+
+def get_executor():
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='download')
+        return executor
+
+def submit_download(batch, url, *args, **kwargs):
+    """
+    Queues a `download_file` call behind the other downloads of its `batch` from the same host.
+    Returns a future for its result.
+    """
+    future = Future()
+    host = urlparse(url).hostname or ''
+    with hosts_lock:
+        batches = host_queues.setdefault(host, OrderedDict())
+        batches.setdefault(batch, deque()).append((future, url, args, kwargs))
+    start_ready(host)
+    return future
+
+def start_ready(host):
+    with hosts_lock:
+        batches = host_queues.get(host)
+        while batches and host_running.get(host, 0) < max_per_host:
+            batch, queue = next(iter(batches.items()))
+            job = queue.popleft()
+            if queue:
+                batches.move_to_end(batch)
+            else:
+                del batches[batch]
+            host_running[host] = host_running.get(host, 0) + 1
+            get_executor().submit(run_download, host, *job)
+        if not batches:
+            host_queues.pop(host, None)
+
+def run_download(host, future, url, args, kwargs):
+    try:
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(download_file(url, *args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+    finally:
+        with hosts_lock:
+            host_running[host] -= 1
+            if not host_running[host]:
+                del host_running[host]
+        start_ready(host)
+
+def download_files(jobs):
+    """
+    Downloads a list of files concurrently.
+    Each job is an `(args, kwargs)` pair for `download_file`.
+    Results are returned in the same order as the jobs; if any download fails, its exception is raised
+    after the rest of the jobs have settled.
+    The files are recorded in the database together once all downloads are done.
+    """
+    file_log = FileLogBatch(max_size=len(jobs) or 1, max_age=float('inf'))
+    batch = object()
+    futures = [submit_download(batch, *args, file_log=file_log, **kwargs) for args, kwargs in jobs]
+    results = []
+    error = None
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            error = error or e
+    file_log.flush()
+    if error:
+        raise error
+    return results
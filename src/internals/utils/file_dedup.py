@@ -0,0 +1,44 @@
+import time
+import logging
+from src.lib.files import dedup_file_server_relationships, get_max_file_id, file_server_relationships_unique_index_exists, create_file_server_relationships_unique_index, drop_file_server_relationships_unique_index
+from ..cache.redis import get_redis
+
+# files whose relationships are deduplicated per transaction, and the pause between transactions
+batch_size = 1000
+batch_delay = 0.5
+
+# removes duplicate file server relationships in small batches so the table is never locked for long,
+# then makes (file_id, remote_path) unique. progress is kept in redis, so restarts pick up where they stopped.
+# needs to be run in a thread itself
+def run():
+    redis = get_redis()
+    progress_key = 'file_server_relationships_dedup:next_file_id'
+    while not file_server_relationships_unique_index_exists():
+        # an invalid index left by a failed build goes first, so it can't reject writes in the meantime
+        drop_file_server_relationships_unique_index()
+        deduplicate(redis, progress_key)
+        try:
+            create_file_server_relationships_unique_index()
+        except Exception:
+            # most likely a duplicate slipped in while scanning; scan the table again
+            logging.exception('Error while building unique index on file server relationships')
+            time.sleep(60)
+        redis.delete(progress_key)
+
+def deduplicate(redis, progress_key):
+    next_file_id = int(redis.get(progress_key) or 0)
+    # files added after this point are written without duplicates
+    last_file_id = get_max_file_id()
+    deleted = 0
+    while next_file_id <= last_file_id:
+        try:
+            deleted += dedup_file_server_relationships(next_file_id, next_file_id + batch_size)
+        except Exception:
+            logging.exception(f'Error while deduplicating file server relationships from file {next_file_id}')
+            time.sleep(60)
+            continue
+        next_file_id += batch_size
+        redis.set(progress_key, next_file_id)
+        time.sleep(batch_delay)
+
+    logging.info(f'Deleted {deleted} duplicate file server relationships. Building unique index.')
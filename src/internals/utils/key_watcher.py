@@ -1,10 +1,12 @@
 import config
-import redis
 import random
 import string
 import time
 import json
+import logging
+from threading import BoundedSemaphore, Lock, Event
 from .flask_thread import FlaskThread
+from .thread_master import JobPool, INTERACTIVE, AUTO_IMPORT
 from src.internals.utils import logger
 from src.internals.utils.encryption import encrypt_and_log_session
 from src.lib.import_manager import import_posts
@@ -16,81 +18,295 @@ from src.importers import gumroad
 from src.importers import discord
 from src.importers import fantia
 
-# a function that first runs existing import requests in a staggered manner (they may be incomplete as importers should delete their keys when they are done) then watches redis for new keys and handles queueing
+# import ids waiting to be picked up by any archiver; the data of each import stays in `imports:{import_id}`
+queue_key = 'import_queue'
+# auto-imports are only taken when no manual import is waiting
+auto_queue_key = 'import_queue:auto'
+# archivers that have ever taken jobs, so their processing lists can be found without KEYS
+archivers_key = 'archivers'
+# an archiver whose heartbeat is older than this is considered dead, and its jobs are handed to the others
+heartbeat_ttl = getattr(config, 'archiver_heartbeat_ttl', 10)
+# milliseconds an archiver's claim on a running import lasts unless renewed by its heartbeat
+lease_ttl = getattr(config, 'import_lease_ttl', 10000)
+# imports this archiver runs at once
+archiver_workers = getattr(config, 'archiver_workers', 100)
+archiver_workers_per_service = getattr(config, 'archiver_workers_per_service', 50)
+# jobs taken on top of that, so the pool can put manual imports and other contributors first,
+# and a job held back by its service's cap doesn't leave a worker idle
+archiver_prefetch = getattr(config, 'archiver_prefetch', 20)
+# `imports:*` keys set by producers that don't enqueue them are picked up by a SCAN this often,
+# or right away with the keyspace bridge, which needs `notify-keyspace-events K$` on the redis server
+import_scan_seconds = getattr(config, 'import_scan_seconds', 60)
+keyspace_bridge = getattr(config, 'import_keyspace_bridge', False)
+
+def processing_key(archiver_id):
+    return f'import_processing:{archiver_id}'
+
+def heartbeat_key(archiver_id):
+    return f'archiver_heartbeat:{archiver_id}'
+
+# leases are only renewed and released by the archiver holding them
+renew_lease_script = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+release_lease_script = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+def lease_key(import_id):
+    return f'import_lease:{import_id}'
+
+def claim_lease(import_id, archiver_id):
+    return bool(get_redis().set(lease_key(import_id), archiver_id, nx=True, px=lease_ttl))
+
+def renew_lease(import_id, archiver_id):
+    return bool(get_redis().eval(renew_lease_script, 1, lease_key(import_id), archiver_id, lease_ttl))
+
+def release_lease(import_id, archiver_id):
+    get_redis().eval(release_lease_script, 1, lease_key(import_id), archiver_id)
+
+def get_lease_owner(import_id):
+    owner = get_redis().get(lease_key(import_id))
+    return owner.decode('utf-8') if owner else None
+
+def enqueue_import(import_id, data = None):
+    """
+    Queues an import for the archivers. `data` is stored as `imports:{import_id}` when given;
+    otherwise the key must already be set. An import id is only queued once until its job is over.
+    """
+    redis = get_redis()
+    if data is not None:
+        redis.set(f'imports:{import_id}', json.dumps(data))
+    else:
+        try:
+            data = json.loads(redis.get(f'imports:{import_id}') or 'null')
+        except ValueError:
+            pass
+    # guards against the startup scan and the keyspace bridge of several archivers queueing the same key
+    if redis.set(f'import_queued:{import_id}', '1', nx=True, ex=60 * 60 * 24):
+        redis.lpush(get_queue_key(data), import_id)
+        return True
+    return False
+
+def get_queue_key(data):
+    if isinstance(data, dict) and data.get('priority') == 'auto_import':
+        return auto_queue_key
+    return queue_key
+
+def take_job(redis, archiver_id):
+    """
+    Moves the next job to this archiver's processing list, manual imports first.
+    Returns `None` if there was nothing to take for a second.
+    """
+    for key in (queue_key, auto_queue_key):
+        import_id = redis.rpoplpush(key, processing_key(archiver_id))
+        if import_id is not None:
+            return import_id
+    # BRPOPLPUSH only waits on one list, so auto-imports are checked again each time this times out
+    return redis.brpoplpush(queue_key, processing_key(archiver_id), timeout=1)
+
+def get_import_target(key_data):
+    import_id = key_data['import_id']
+    key = key_data['key']
+    service = key_data['service']
+    allowed_to_auto_import = key_data.get('auto_import', False)
+    allowed_to_save_session = key_data.get('save_session_key', False)
+    allowed_to_scrape_dms = key_data.get('save_dms', False)
+    channel_ids = key_data['channel_ids']
+    contributor_id = key_data['contributor_id']
+    # set for auto-imports of saved keys
+    key_id = key_data.get('key_id')
+
+    if key and service and allowed_to_save_session:
+        try:
+            encrypt_and_log_session(import_id, service, key)
+        except:
+            pass
+
+    if service == 'patreon':
+        return patreon.import_posts, (key, allowed_to_scrape_dms, contributor_id, allowed_to_auto_import, key_id)
+    elif service == 'fanbox':
+        return fanbox.import_posts, (key, contributor_id, allowed_to_auto_import, key_id)
+    elif service == 'subscribestar':
+        return subscribestar.import_posts, (key, contributor_id, allowed_to_auto_import, key_id)
+    elif service == 'gumroad':
+        return gumroad.import_posts, (key, contributor_id, allowed_to_auto_import, key_id)
+    elif service == 'fantia':
+        return fantia.import_posts, (key, contributor_id, allowed_to_auto_import, key_id)
+    elif service == 'discord':
+        return discord.import_posts, (key, channel_ids.strip().replace(" ", ""), contributor_id, allowed_to_auto_import, key_id)
+    return None, None
+
+def requeue_dead_archivers():
+    redis = get_redis()
+    for archiver_id in redis.smembers(archivers_key):
+        archiver_id = archiver_id.decode('utf-8')
+        if redis.exists(heartbeat_key(archiver_id)):
+            continue
+        # jobs go back one by one, so none are lost if this archiver dies halfway through too;
+        # they were started already, so they go ahead of auto-imports
+        while redis.rpoplpush(processing_key(archiver_id), queue_key):
+            pass
+        redis.srem(archivers_key, archiver_id)
+
+def finish_import(import_id):
+    """
+    Forgets an import whose job is over, however it ended, so the same id can be queued again.
+    """
+    redis = get_redis()
+    redis.delete(f'imports:{import_id}', f'import_queued:{import_id}')
+
+def keep_alive(archiver_id, leases, leases_lock, stopped):
+    redis = get_redis()
+    scanned_at = time.monotonic()
+    while not stopped.is_set():
+        redis.set(heartbeat_key(archiver_id), '1', ex=heartbeat_ttl)
+        with leases_lock:
+            held = list(leases)
+        for import_id in held:
+            try:
+                if not renew_lease(import_id, archiver_id):
+                    logger.log(import_id, 'Lost the claim on this import; it may be run again by another archiver.', 'warning')
+            except:
+                pass
+        try:
+            requeue_dead_archivers()
+        except:
+            pass
+        if time.monotonic() - scanned_at >= import_scan_seconds:
+            scanned_at = time.monotonic()
+            try:
+                enqueue_existing_imports()
+            except:
+                logging.exception('Error while scanning for unqueued imports')
+        stopped.wait(min(heartbeat_ttl, lease_ttl / 1000) / 3)
+
+def enqueue_existing_imports():
+    redis = get_redis()
+    for key in redis.scan_iter(match='imports:*', count=1000):
+        enqueue_import(key.decode('utf-8').split(':', 1)[1])
+
+def bridge_keyspace_events():
+    pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+    pubsub.psubscribe('__keyspace@*__:imports:*')
+    for message in pubsub.listen():
+        if message['data'] == b'set':
+            enqueue_import(message['channel'].decode('utf-8').split(':imports:', 1)[1])
+
+# runs imports as they are queued, without polling: a job is moved to this archiver's processing list while it runs
+# and removed once it is over, so the jobs of an archiver that dies are handed back to the queue by the others;
+# a lease on each running import makes sure no two archivers run it at once
 # needs to be run in a thread itself
 # remember to clear logs after successful import
-def watch(queue_limit=2000):
+def watch():
     archiver_id = ''.join(random.choice(string.ascii_letters + string.digits) for x in range(16))
 
     redis = get_redis()
-    threads_to_run = []
-    while True:
-        for thread in threads_to_run:
-            if not thread.is_alive():
-                threads_to_run.remove(thread)
-        
-        keys = redis.keys('imports:*')
-        for key in keys:
-            key_data = redis.get(key)
-            if key_data:
-                key_data = json.loads(key_data)
-                if redis.get(f"running_imports:{archiver_id}:{key_data['import_id']}"):
-                    continue
-                
-                if len(threads_to_run) < queue_limit:
-                    target = None
-                    args = None
-                    # data = {
-                    #     'import_id': import_id,
-                    #     'key': key,
-                    #     'service': service,
-                    #     'allowed_to_auto_import': allowed_to_auto_import,
-                    #     'allowed_to_save_session': allowed_to_save_session,
-                    #     'allowed_to_scrape_dms': allowed_to_scrape_dms,
-                    #     'channel_ids': channel_ids,
-                    #     'contributor_id': contributor_id
-                    # }
-                    import_id = key_data['import_id']
-                    key = key_data['key']
-                    service = key_data['service']
-                    allowed_to_auto_import = key_data.get('auto_import', False)
-                    allowed_to_save_session = key_data.get('save_session_key', False)
-                    allowed_to_scrape_dms = key_data.get('save_dms', False)
-                    channel_ids = key_data['channel_ids']
-                    contributor_id = key_data['contributor_id']
-
-                    if key and service and allowed_to_save_session:
-                        try:
-                            encrypt_and_log_session(import_id, service, key)
-                        except:
-                            pass
-                    
-                    if service == 'patreon':
-                        target = patreon.import_posts
-                        args = (key, allowed_to_scrape_dms, contributor_id, allowed_to_auto_import, None)
-                    elif service == 'fanbox':
-                        target = fanbox.import_posts
-                        args = (key, contributor_id, allowed_to_auto_import, None)
-                    elif service == 'subscribestar':
-                        target = subscribestar.import_posts
-                        args = (key, contributor_id, allowed_to_auto_import, None)
-                    elif service == 'gumroad':
-                        target = gumroad.import_posts
-                        args = (key, contributor_id, allowed_to_auto_import, None)
-                    elif service == 'fantia':
-                        target = fantia.import_posts
-                        args = (key, contributor_id, allowed_to_auto_import, None)
-                    elif service == 'discord':
-                        target = discord.import_posts
-                        args = (key, channel_ids.strip().replace(" ", ""), contributor_id, allowed_to_auto_import, None)
-
-                    if target is not None and args is not None:
-                        logger.log(import_id, f'Starting import. Your import id is {import_id}.')
-                        thread = FlaskThread(target=import_posts, args=(import_id, target, args))
-                        thread.start()
-                        threads_to_run.append(thread)
-                        redis.set(f"running_imports:{archiver_id}:{key_data['import_id']}", '1')
-                    else:
-                        logger.log(import_id, f'Error starting import. Your import id is {import_id}.')
-        
-        time.sleep(1)
\ No newline at end of file
+    redis.set(heartbeat_key(archiver_id), '1', ex=heartbeat_ttl)
+    redis.sadd(archivers_key, archiver_id)
+    # imports this archiver holds a lease on, renewed along with its heartbeat
+    leases = set()
+    leases_lock = Lock()
+    stopped = Event()
+    FlaskThread(target=keep_alive, args=(archiver_id, leases, leases_lock, stopped), daemon=True).start()
+    if keyspace_bridge:
+        FlaskThread(target=bridge_keyspace_events, daemon=True).start()
+
+    pool = JobPool(archiver_workers, archiver_workers_per_service)
+    # only take jobs there are (nearly) workers for, leaving the rest to other archivers
+    slots = BoundedSemaphore(archiver_workers + archiver_prefetch)
+    try:
+        enqueue_existing_imports()
+        while True:
+            slots.acquire()
+            import_id = None
+            try:
+                while import_id is None:
+                    import_id = take_job(redis, archiver_id)
+                start_job(redis, archiver_id, import_id, pool, slots, leases, leases_lock)
+            except Exception:
+                logging.exception(f'Error while taking import {import_id} from the queue')
+                if import_id is not None:
+                    # hand the job back rather than leave it in this archiver's processing list
+                    try:
+                        with leases_lock:
+                            leases.discard(import_id.decode('utf-8'))
+                        release_lease(import_id.decode('utf-8'), archiver_id)
+                        redis.lpush(queue_key, import_id)
+                        redis.lrem(processing_key(archiver_id), 1, import_id)
+                    except Exception:
+                        logging.exception(f'Error while requeueing import {import_id}')
+                slots.release()
+                time.sleep(1)
+    finally:
+        # without a heartbeat the other archivers take over this one's jobs
+        stopped.set()
+        redis.delete(heartbeat_key(archiver_id))
+
+def start_job(redis, archiver_id, import_id, pool, slots, leases, leases_lock):
+    """
+    Runs a job taken from the queue, or lets go of it. The slot taken for it is released once it is over.
+    """
+    queued_id = import_id.decode('utf-8')
+
+    def acknowledge(job):
+        with leases_lock:
+            leases.discard(queued_id)
+        try:
+            finish_import(queued_id)
+            release_lease(queued_id, archiver_id)
+            redis.lrem(processing_key(archiver_id), 1, import_id)
+        except Exception:
+            # the lease runs out on its own and dead archivers' lists are swept
+            logging.exception(f'Error while acknowledging import {queued_id}')
+        finally:
+            slots.release()
+
+    key_data = redis.get(f"imports:{queued_id}")
+    if not key_data:
+        # finished (or dropped) after it was queued
+        acknowledge(None)
+        return
+
+    if not claim_lease(queued_id, archiver_id):
+        owner = get_lease_owner(queued_id)
+        if owner and not redis.exists(heartbeat_key(owner)):
+            # handed back from a dead archiver before its lease ran out; try again once it has
+            time.sleep(1)
+            redis.lpush(queue_key, import_id)
+        # otherwise it is running on a live archiver already
+        redis.lrem(processing_key(archiver_id), 1, import_id)
+        slots.release()
+        return
+    with leases_lock:
+        leases.add(queued_id)
+
+    try:
+        key_data = json.loads(key_data)
+        import_id = key_data['import_id']
+        target, args = get_import_target(key_data)
+    except Exception:
+        # the data can't be fixed by retrying, so the job is dropped
+        logger.log(queued_id, f'Error starting import. Your import id is {queued_id}.', 'exception')
+        acknowledge(None)
+        return
+    if target is None or args is None:
+        logger.log(import_id, f'Error starting import. Your import id is {import_id}.')
+        acknowledge(None)
+        return
+
+    logger.log(import_id, f'Starting import. Your import id is {import_id}.')
+    pool.submit(
+        import_posts, import_id, target, args,
+        callback=acknowledge,
+        priority=AUTO_IMPORT if key_data.get('priority') == 'auto_import' else INTERACTIVE,
+        owner=key_data.get('contributor_id'),
+        service=key_data.get('service'),
+        log_id=import_id
+    )
@@ -1,13 +1,91 @@
 import config
 import random
+import time
 import logging
+from threading import Lock
+
+# a proxy failing this many times in a row is left out of rotation for a while
+eject_after_failures = getattr(config, 'proxy_eject_after_failures', 3)
+eject_seconds = getattr(config, 'proxy_eject_seconds', 60)
+# how much each new latency sample moves the running average
+latency_smoothing = 0.2
+
+stats_lock = Lock()
+proxy_stats = {}
+
+def get_stats_of(proxy):
+    if proxy not in proxy_stats:
+        proxy_stats[proxy] = {
+            'successes': 0,
+            'failures': 0,
+            'consecutive_failures': 0,
+            'latency': None,
+            'ejected_until': 0
+        }
+    return proxy_stats[proxy]
+
+def get_weight(stats, default_latency):
+    # smoothed success rate over average latency; proxies that were never used get the benefit of the doubt
+    success_rate = (stats['successes'] + 1) / (stats['successes'] + stats['failures'] + 2)
+    latency = stats['latency'] if stats['latency'] is not None else default_latency
+    return success_rate / max(latency, 0.05)
+
+def pick_proxy():
+    now = time.time()
+    with stats_lock:
+        stats = [(proxy, get_stats_of(proxy)) for proxy in config.proxies]
+        candidates = [(proxy, stat) for proxy, stat in stats if stat['ejected_until'] <= now]
+        if not candidates:
+            # everything is ejected; better to try a bad proxy than to stop importing
+            candidates = stats
+        latencies = [stat['latency'] for _, stat in candidates if stat['latency'] is not None]
+        default_latency = min(latencies) if latencies else 1.0
+        weights = [get_weight(stat, default_latency) for _, stat in candidates]
+    return random.choices([proxy for proxy, _ in candidates], weights=weights)[0]
 
 def get_proxy():
     if config.proxies and len(config.proxies):
-        proxy = random.choice(config.proxies)
+        proxy = pick_proxy()
         return {
             "http": proxy,
             "https": proxy
         }
     else:
         return None
+
+def report_proxy(proxies, success, latency = None):
+    """
+    Records the outcome of a request made through `proxies` (as returned by `get_proxy`).
+    """
+    if not proxies:
+        return
+    proxy = proxies.get('https') or proxies.get('http')
+    if proxy not in config.proxies:
+        return
+    with stats_lock:
+        stats = get_stats_of(proxy)
+        if success:
+            stats['successes'] += 1
+            stats['consecutive_failures'] = 0
+            if latency is not None:
+                stats['latency'] = latency if stats['latency'] is None else stats['latency'] + latency_smoothing * (latency - stats['latency'])
+        else:
+            stats['failures'] += 1
+            stats['consecutive_failures'] += 1
+            if stats['consecutive_failures'] >= eject_after_failures:
+                stats['ejected_until'] = time.time() + eject_seconds
+                logging.warning(f'Proxy ejected for {eject_seconds}s after {stats["consecutive_failures"]} failures in a row')
+
+def get_proxy_stats():
+    now = time.time()
+    with stats_lock:
+        return [
+            {
+                'index': index,
+                'successes': stats['successes'],
+                'failures': stats['failures'],
+                'latency': stats['latency'],
+                'ejected': stats['ejected_until'] > now
+            }
+            for index, stats in ((index, get_stats_of(proxy)) for index, proxy in enumerate(config.proxies or []))
+        ]
@@ -0,0 +1,86 @@
+import config
+import time
+from threading import Lock
+from .upstreams import get_upstream
+from ..cache.redis import get_redis
+
+# (requests per second, burst) per upstream; upstreams not listed here are not limited
+rate_limits = getattr(config, 'rate_limits', {
+    'patreon': (5, 20),
+    'fanbox': (5, 20),
+    'fantia': (5, 20),
+    'subscribestar': (3, 10),
+    'gumroad': (3, 10),
+    'discord': (2, 5)
+})
+# share the buckets between processes (uwsgi workers, importer workers) through redis
+rate_limit_redis = getattr(config, 'rate_limit_redis', False)
+
+# takes a token from the bucket, letting it go negative, and returns how long the caller has to wait for it
+redis_take_token = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate) - 1
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 60)
+if tokens >= 0 then
+    return '0'
+end
+return tostring(-tokens / rate)
+"""
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - 1
+            self.updated = now
+            return max(0, -self.tokens / self.rate)
+
+buckets = {}
+buckets_lock = Lock()
+stats_lock = Lock()
+stats = {}
+
+def take_token(upstream, rate, burst):
+    if rate_limit_redis:
+        return float(get_redis().eval(redis_take_token, 1, f'rate_limit:{upstream}', rate, burst, time.time()))
+    with buckets_lock:
+        if upstream not in buckets:
+            buckets[upstream] = TokenBucket(rate, burst)
+        bucket = buckets[upstream]
+    return bucket.take()
+
+def acquire(url):
+    """
+    Blocks until a request to `url` is allowed by the rate limit of its upstream.
+    """
+    upstream = get_upstream(url)
+    if upstream not in rate_limits:
+        return
+    rate, burst = rate_limits[upstream]
+    wait = take_token(upstream, rate, burst)
+    if wait > 0:
+        time.sleep(wait)
+    with stats_lock:
+        upstream_stats = stats.setdefault(upstream, { 'requests': 0, 'waited': 0, 'total_wait': 0.0, 'max_wait': 0.0 })
+        upstream_stats['requests'] += 1
+        if wait > 0:
+            upstream_stats['waited'] += 1
+            upstream_stats['total_wait'] += wait
+            upstream_stats['max_wait'] = max(upstream_stats['max_wait'], wait)
+
+def get_rate_limit_stats():
+    with stats_lock:
+        return { upstream: dict(upstream_stats) for upstream, upstream_stats in stats.items() }
@@ -1,27 +1,193 @@
+import config
+import time
+import json
+import hashlib
 import cloudscraper
-from requests import Session
-from requests.adapters import HTTPAdapter
+from collections import OrderedDict
+from threading import Lock, local
+from weakref import WeakValueDictionary
+from http.cookiejar import DefaultCookiePolicy
 from requests.packages.urllib3.util.retry import Retry
+from .session_pool import PooledAdapter, get_session
+from .concurrency import get_limiter, get_route
+from .rate_limiter import acquire as acquire_rate_limit
+from .upstreams import get_upstream
+
+# solved cloudflare challenges are kept in cached scrapers for this long, and for this many (service, proxy, user)s
+# in each thread
+scraper_session_ttl = getattr(config, 'scraper_session_ttl', 1800)
+scraper_session_cache_size = getattr(config, 'scraper_session_cache_size', 64)
+
+class ScraperCache(OrderedDict):
+    pass
+
+# sessions aren't thread-safe, so every thread keeps scrapers of its own
+thread_scrapers = local()
+# every thread's cache, for the stats; they go away with their threads
+caches = WeakValueDictionary()
+caches_lock = Lock()
+stats_lock = Lock()
+stats = {
+    'hits': 0,
+    'misses': 0,
+    'challenges_solved': 0,
+    'invalidated': 0
+}
+
+class AdaptiveRetry(Retry):
+    """
+    Lets the concurrency limiter of the upstream see the responses that are retried
+    before they ever reach the adapter, and honors their `Retry-After`.
+    Retries are sent from below the adapter, so while one waits to be resent it gives its slot
+    back to the limiter, and it takes its token from the rate limiter before taking the slot again.
+    """
+    origin = None
+    route = None
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        origin = f'{_pool.scheme}://{_pool.host}' if _pool is not None else None
+        route = get_route(origin + (url or '')) if origin else None
+        if response is not None and origin:
+            get_limiter(origin).backoff(response.status, response.headers, route)
+        retry = super().increment(method, url, response=response, error=error, _pool=_pool, _stacktrace=_stacktrace)
+        retry.origin = origin
+        retry.route = route
+        return retry
+
+    def sleep(self, response=None):
+        if not self.origin:
+            return super().sleep(response)
+        limiter = get_limiter(self.origin)
+        limiter.release()
+        try:
+            super().sleep(response)
+            acquire_rate_limit(self.origin)
+        finally:
+            limiter.acquire(self.route)
+
+class ClearanceCookiePolicy(DefaultCookiePolicy):
+    # a cached scraper can outlive the import that created it, so only cloudflare's own cookies may stick
+    def set_ok(self, cookie, request):
+        return cookie.name.startswith(('cf_', '__cf')) and super().set_ok(cookie, request)
+
+def count(key, amount = 1):
+    with stats_lock:
+        stats[key] += amount
+
+def get_clearance(scraper):
+    return [cookie.value for cookie in scraper.cookies if cookie.name == 'cf_clearance']
+
+def get_cache():
+    cache = getattr(thread_scrapers, 'cache', None)
+    if cache is None:
+        cache = thread_scrapers.cache = ScraperCache()
+        with caches_lock:
+            caches[id(cache)] = cache
+    return cache
+
+def get_session_key(kwargs):
+    """
+    Tells users apart by the cookies and authorization header sent with a request, without keeping them.
+    """
+    cookies = kwargs.get('cookies') or {}
+    if not isinstance(cookies, dict):
+        cookies = { cookie.name: cookie.value for cookie in cookies }
+    authorization = next((value for name, value in (kwargs.get('headers') or {}).items() if name.lower() == 'authorization'), None)
+    if not cookies and authorization is None:
+        return None
+    return hashlib.sha256(json.dumps([sorted(cookies.items()), authorization], default=str).encode('utf-8')).hexdigest()
+
+def is_cloudflare_block(response):
+    return response.status_code in (403, 503) and response.headers.get('server', '').lower() == 'cloudflare'
+
+class CachedScraper:
+    """
+    Stands in for a cloudscraper session, sending each request through the scraper cached in the
+    current thread for its service, proxy and user, so solved challenges and open connections are reused.
+    The user is told by `session_key`, or else by the credentials sent with the request.
+    """
+    def __init__(self, retry, policy, service=None, session_key=None):
+        self.retry = retry
+        self.policy = policy
+        self.service = service
+        self.session_key = session_key
+
+    def get_key(self, url, kwargs):
+        proxies = kwargs.get('proxies') or {}
+        proxy = proxies.get('https') or proxies.get('http')
+        return (self.service or get_upstream(url), proxy, self.session_key or get_session_key(kwargs), self.policy)
+
+    def get_scraper(self, key):
+        now = time.monotonic()
+        scrapers = get_cache()
+        entry = scrapers.get(key)
+        if entry and now - entry[1] < scraper_session_ttl:
+            scrapers.move_to_end(key)
+            count('hits')
+            return entry[0]
+        scraper = cloudscraper.create_scraper()
+        scraper.cookies.set_policy(ClearanceCookiePolicy())
+        adapter = PooledAdapter(max_retries=self.retry)
+        scraper.mount('http://', adapter)
+        scraper.mount('https://', adapter)
+        scrapers[key] = (scraper, now)
+        scrapers.move_to_end(key)
+        while len(scrapers) > scraper_session_cache_size:
+            scrapers.popitem(last=False)
+        count('misses')
+        return scraper
+
+    def invalidate(self, key, scraper):
+        scrapers = get_cache()
+        if key in scrapers and scrapers[key][0] is scraper:
+            del scrapers[key]
+            count('invalidated')
+
+    def request(self, method, url, **kwargs):
+        key = self.get_key(url, kwargs)
+        scraper = self.get_scraper(key)
+        clearance = get_clearance(scraper)
+        response = scraper.request(method, url, **kwargs)
+        if get_clearance(scraper) != clearance:
+            count('challenges_solved')
+        if is_cloudflare_block(response):
+            # the clearance expired or the challenge could not be solved; start over on the next request
+            self.invalidate(key, scraper)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
 
 def create_scrapper_session(
     useCloudscraper=True,
     retries=10,
     backoff_factor=0.3,
-    status_forcelist=(500, 502, 504, 423)
+    status_forcelist=(429, 500, 502, 503, 504, 423),
+    service=None,
+    session_key=None
 ):
-    session = None
     if useCloudscraper:
-        session = cloudscraper.create_scraper()
-    else:
-        session = Session()
-    retry = Retry(
+        # cloudflare challenges come as 503s, which cloudscraper has to see rather than have retried
+        status_forcelist = tuple(status for status in status_forcelist if status != 503)
+    retry = AdaptiveRetry(
         total=retries,
         read=retries,
         connect=retries,
         backoff_factor=backoff_factor,
         status_forcelist=status_forcelist,
+        respect_retry_after_header=True,
     )
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    return session
\ No newline at end of file
+    if not useCloudscraper:
+        # plain sessions are pooled per thread and retry policy, so their connections are kept alive
+        return get_session(f'scrapper:{retries}:{backoff_factor}:{status_forcelist}', max_retries=retry)
+    # `service` defaults to the one each requested url belongs to
+    return CachedScraper(retry, (retries, backoff_factor, status_forcelist), service=service, session_key=session_key)
+
+def get_scraper_stats():
+    with caches_lock:
+        size = sum(len(cache) for cache in list(caches.values()))
+    with stats_lock:
+        return { **stats, 'cached': size }
@@ -0,0 +1,77 @@
+import config
+import time
+from threading import local
+from http.cookiejar import DefaultCookiePolicy
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout, RetryError
+from .proxy import report_proxy
+from .rate_limiter import acquire as acquire_rate_limit
+from .concurrency import get_limiter, get_route
+from .circuit_breaker import before_request, record_result
+
+# connection pools kept per session (one per host/proxy), and connections kept per pool
+pool_connections = getattr(config, 'http_pool_connections', 20)
+pool_maxsize = getattr(config, 'http_pool_maxsize', 20)
+keep_alive = getattr(config, 'http_keep_alive', True)
+
+sessions = local()
+
+class PooledAdapter(HTTPAdapter):
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('pool_connections', pool_connections)
+        kwargs.setdefault('pool_maxsize', pool_maxsize)
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, proxies=None, **kwargs):
+        before_request(request.url)
+        # wait for a token before taking a slot, so requests waiting on the bucket don't hold the upstream's slots
+        acquire_rate_limit(request.url)
+        limiter = get_limiter(request.url)
+        route = get_route(request.url)
+        limiter.acquire(route)
+        try:
+            start = time.monotonic()
+            response = super().send(request, proxies=proxies, **kwargs)
+        except (ConnectionError, Timeout):
+            limiter.release()
+            record_result(request.url, False)
+            report_proxy(proxies, False)
+            raise
+        except RetryError:
+            # the upstream kept answering with errors until the retries ran out
+            limiter.release()
+            record_result(request.url, False)
+            raise
+        except:
+            limiter.release()
+            raise
+        latency = time.monotonic() - start
+        record_result(request.url, response.status_code < 500)
+        limiter.release(response.status_code, response.headers, latency, route)
+        report_proxy(proxies, True, latency)
+        return response
+
+def create_session(max_retries=0):
+    session = Session()
+    # sessions are shared between imports of different users, so cookies set by responses must never stick;
+    # cookies passed to a request are still sent with it
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    adapter = PooledAdapter(max_retries=max_retries)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def get_session(name='default', max_retries=0):
+    """
+    Returns a session private to the current thread, so connections (including proxied ones)
+    are kept alive and reused between calls instead of being set up for every request.
+    Sessions are told apart by `name`; `max_retries` only applies when the session is first created.
+    """
+    if not hasattr(sessions, 'by_name'):
+        sessions.by_name = {}
+    if name not in sessions.by_name:
+        sessions.by_name[name] = create_session(max_retries=max_retries)
+    return sessions.by_name[name]
@@ -1,18 +1,200 @@
-from typing import List
-from threading import Thread
-# a function that starts other threads in a queue
-# needs to be run in a thread itself
-def run(threads: List[Thread], limit=10):
-    pos = 0
-    threads_to_run = []
-    while pos < len(threads):
-        for thread in threads_to_run:
-            if not thread.is_alive():
-                threads_to_run.remove(thread)
-        if not len(threads_to_run) > limit:
-            # start and add more threads until it reaches the slot limit
-            while len(threads_to_run) < limit:
-                thread = threads[pos]
-                thread.start()
-                threads_to_run.append(thread)
-                pos += 1
\ No newline at end of file
+import config
+import time
+import itertools
+from collections import deque, OrderedDict
+from threading import Condition, Event, Lock
+from .flask_thread import FlaskThread
+from . import logger
+
+# imports running at once; the rest wait their turn
+import_workers = getattr(config, 'import_workers', 10)
+# imports of the same service running at once per pool, so one slow site can't take every worker
+import_workers_per_service = getattr(config, 'import_workers_per_service', 5)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+# priority classes, served strictly in this order
+INTERACTIVE = 0
+AUTO_IMPORT = 1
+
+job_ids = itertools.count(1)
+
+class Job:
+    def __init__(self, target, args, kwargs, callback, priority, owner, service, log_id):
+        self.id = next(job_ids)
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs
+        self.callback = callback
+        self.priority = priority
+        self.owner = owner
+        self.service = service
+        self.log_id = log_id
+        self.state = QUEUED
+        self.result = None
+        self.exception = None
+        self.submitted_at = time.monotonic()
+        self.finished = Event()
+
+    def wait(self, timeout=None):
+        return self.finished.wait(timeout)
+
+class JobPool:
+    """
+    Runs jobs on a fixed number of worker threads.
+    Interactive jobs go before auto-imports; within a priority class, owners (contributors) take turns,
+    each owner's jobs run in the order they were submitted, and no service runs more than its share of workers at once.
+    Workers are started on the first submission and run with the app context of the submitter.
+    """
+    def __init__(self, max_workers, max_per_service=None):
+        self.max_workers = max_workers
+        self.max_per_service = max_per_service or max_workers
+        # priority -> owner -> jobs; owners are rotated to the back once one of their jobs starts
+        self.queues = {}
+        self.running = 0
+        self.running_per_service = {}
+        # moving average of how long jobs run, for estimating when queued ones start
+        self.average_duration = None
+        self.workers = []
+        self.condition = Condition()
+
+    def submit(self, target, *args, callback=None, priority=INTERACTIVE, owner=None, service=None, log_id=None, **kwargs):
+        """
+        Queues `target(*args, **kwargs)` and returns its `Job` right away.
+        `callback` is called with the job once it has finished, failed or been cancelled.
+        When `log_id` is given, the position of the job in the queue is reported to that log.
+        """
+        job = Job(target, args, kwargs, callback, priority, owner, service, log_id)
+        with self.condition:
+            self.start_workers()
+            self.queues.setdefault(priority, OrderedDict()).setdefault(owner, deque()).append(job)
+            position, eta = self.estimate(job)
+            self.condition.notify()
+        if log_id and position:
+            logger.log(log_id, f'Import queued at position {position}; estimated to start in {format_duration(eta)}.' if eta is not None else f'Import queued at position {position}.')
+        return job
+
+    def estimate(self, job):
+        """
+        Returns how many queued jobs will start before `job`, and roughly how many seconds that will take.
+        """
+        owners = self.queues[job.priority]
+        ahead_of_owner = list(owners[job.owner]).index(job)
+        position = sum(
+            len(jobs)
+            for priority, queue in self.queues.items() if priority < job.priority
+            for jobs in queue.values()
+        )
+        # the other owners of the class get a turn for each of this owner's jobs ahead of this one
+        position += ahead_of_owner + sum(
+            min(len(jobs), ahead_of_owner + 1)
+            for owner, jobs in owners.items() if owner != job.owner
+        )
+        if self.running < self.max_workers and position == 0:
+            return 0, 0
+        if self.average_duration is None:
+            return position + 1, None
+        return position + 1, (position // self.max_workers + 1) * self.average_duration
+
+    def cancel(self, job):
+        """
+        Drops a job that has not started yet; returns False if it is already running or over.
+        """
+        with self.condition:
+            if job.state != QUEUED:
+                return False
+            self.remove(job)
+            job.state = CANCELLED
+        self.finish(job)
+        return True
+
+    def remove(self, job):
+        owners = self.queues[job.priority]
+        owners[job.owner].remove(job)
+        if not owners[job.owner]:
+            del owners[job.owner]
+
+    def next_job(self):
+        for priority in sorted(self.queues):
+            owners = self.queues[priority]
+            for owner, jobs in owners.items():
+                job = next((job for job in jobs if job.service is None or self.running_per_service.get(job.service, 0) < self.max_per_service), None)
+                if job:
+                    self.remove(job)
+                    if owner in owners:
+                        owners.move_to_end(owner)
+                    return job
+        return None
+
+    def start_workers(self):
+        while len(self.workers) < self.max_workers:
+            worker = FlaskThread(target=self.work, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def work(self):
+        while True:
+            with self.condition:
+                job = self.next_job()
+                while job is None:
+                    self.condition.wait()
+                    job = self.next_job()
+                job.state = RUNNING
+                self.running += 1
+                self.running_per_service[job.service] = self.running_per_service.get(job.service, 0) + 1
+            started_at = time.monotonic()
+            if job.log_id and started_at - job.submitted_at >= 1:
+                logger.log(job.log_id, f'Import started after waiting {format_duration(started_at - job.submitted_at)} in queue.')
+            try:
+                job.result = job.target(*job.args, **job.kwargs)
+                job.state = DONE
+            except Exception as e:
+                job.exception = e
+                job.state = FAILED
+            duration = time.monotonic() - started_at
+            with self.condition:
+                self.running -= 1
+                self.running_per_service[job.service] -= 1
+                self.average_duration = duration if self.average_duration is None else self.average_duration * 0.9 + duration * 0.1
+                # a job of the service that was capped may be able to start now
+                self.condition.notify_all()
+            self.finish(job)
+
+    def finish(self, job):
+        job.finished.set()
+        if job.callback:
+            try:
+                job.callback(job)
+            except:
+                pass
+
+    def get_stats(self):
+        with self.condition:
+            return {
+                'workers': self.max_workers,
+                'queued': {
+                    priority: sum(len(jobs) for jobs in owners.values())
+                    for priority, owners in self.queues.items()
+                },
+                'running': self.running,
+                'running_per_service': { service: running for service, running in self.running_per_service.items() if running },
+                'average_duration': self.average_duration
+            }
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    return f'{minutes}m {seconds}s' if minutes else f'{seconds}s'
+
+pool = None
+pool_lock = Lock()
+
+def get_pool():
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = JobPool(import_workers, import_workers_per_service)
+        return pool
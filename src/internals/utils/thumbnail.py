@@ -0,0 +1,142 @@
+import config
+import sys
+import queue
+import logging
+import multiprocessing
+from threading import Lock, Thread
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from os import makedirs
+from os.path import join, dirname, basename, exists
+from PIL import Image
+
+# processes decoding images, and how many paths may wait for them before callers are held back
+thumbnail_workers = getattr(config, 'thumbnail_workers', 2)
+thumbnail_queue_size = getattr(config, 'thumbnail_queue_size', 1000)
+# interpreter the processes are started with; found next to the running one when unset,
+# as under uwsgi `sys.executable` is the uwsgi binary
+thumbnail_python = getattr(config, 'thumbnail_python', None)
+# bounding box and jpeg quality of the thumbnail served from `thumbnail/`
+thumbnail_size = getattr(config, 'thumbnail_size', 800)
+thumbnail_quality = getattr(config, 'thumbnail_quality', 60)
+# images with more pixels than this are not thumbnailed at all, so huge scans can't exhaust memory
+thumbnail_max_pixels = getattr(config, 'thumbnail_max_pixels', 100_000_000)
+
+pending = queue.Queue(maxsize=thumbnail_queue_size)
+executor = None
+started = False
+workers_lock = Lock()
+stats_lock = Lock()
+stats = {
+    'queued': 0,
+    'completed': 0,
+    'failed': 0,
+    # thumbnails made in the calling thread because the processes couldn't be started or died
+    'in_process': 0
+}
+
+def get_thumbnail_path(path):
+    return join(config.download_path, 'thumbnail' + path.replace(config.download_path, ''))
+
+def render_thumbnail(path):
+    """
+    Decodes the image at `path` no larger than needed and returns it scaled down to `thumbnail_size`.
+    """
+    image = Image.open(path)
+    width, height = image.size
+    if width * height > thumbnail_max_pixels:
+        raise ValueError(f'Image is too large to thumbnail; {width}x{height}')
+    # lets jpegs decode straight at 1/2, 1/4 or 1/8 scale instead of full resolution
+    image.draft('RGB', (thumbnail_size, thumbnail_size))
+    image = image.convert('RGB')
+    image.thumbnail((thumbnail_size, thumbnail_size), reducing_gap=2.0)
+    return image
+
+def save_thumbnail(image, file):
+    # always jpeg, whatever the name of the source file says
+    image.save(file, 'JPEG', quality=thumbnail_quality)
+
+def make_thumbnail(path):
+    """
+    Writes the thumbnail of the image at `path`.
+    Returns False when the file can't be thumbnailed (not an image, corrupt, too large and the like).
+    """
+    try:
+        image = render_thumbnail(path)
+        thumbnail_path = get_thumbnail_path(path)
+        makedirs(dirname(thumbnail_path), exist_ok=True)
+        save_thumbnail(image, thumbnail_path)
+        return True
+    except:
+        return False
+
+def count(key, amount = 1):
+    with stats_lock:
+        stats[key] += amount
+
+def get_python():
+    if thumbnail_python:
+        return thumbnail_python
+    if 'uwsgi' not in basename(sys.executable or ''):
+        return sys.executable
+    for name in (f'python{sys.version_info[0]}.{sys.version_info[1]}', f'python{sys.version_info[0]}', 'python'):
+        path = join(sys.exec_prefix, 'bin', name)
+        if exists(path):
+            return path
+    return None
+
+def create_executor():
+    # started after other threads may hold locks, which forked children would inherit held
+    context = multiprocessing.get_context('spawn')
+    python = get_python()
+    if python is None:
+        logging.error('No python interpreter found to start thumbnail processes with; set thumbnail_python. Making thumbnails in process')
+        return None
+    context.set_executable(python)
+    return ProcessPoolExecutor(max_workers=thumbnail_workers, mp_context=context)
+
+def work():
+    global executor
+    while True:
+        path = pending.get()
+        try:
+            pool = executor
+            if pool is not None:
+                succeeded = pool.submit(make_thumbnail, path).result()
+            else:
+                count('in_process')
+                succeeded = make_thumbnail(path)
+        except BrokenProcessPool:
+            logging.exception('Thumbnail processes died; making thumbnails in process from now on')
+            with workers_lock:
+                if executor is pool:
+                    executor = None
+            count('in_process')
+            succeeded = make_thumbnail(path)
+        except:
+            succeeded = False
+        count('queued', -1)
+        count('completed' if succeeded else 'failed')
+        pending.task_done()
+
+def start_workers():
+    global executor, started
+    with workers_lock:
+        if not started:
+            started = True
+            executor = create_executor()
+            for _ in range(thumbnail_workers):
+                Thread(target=work, daemon=True).start()
+
+def enqueue_thumbnail(path):
+    """
+    Queues a thumbnail to be made in the background.
+    Blocks while the queue is full, so imports can't outrun the thumbnailer indefinitely.
+    """
+    start_workers()
+    count('queued')
+    pending.put(path)
+
+def get_stats():
+    with stats_lock:
+        return dict(stats)
@@ -0,0 +1,23 @@
+from urllib.parse import urlparse
+
+# hosts (and their subdomains) belonging to each service we import from
+service_hosts = {
+    'patreon': ['patreon.com', 'patreonusercontent.com'],
+    'fanbox': ['fanbox.cc', 'pixiv.net', 'pximg.net'],
+    'fantia': ['fantia.jp'],
+    'subscribestar': ['subscribestar.adult', 'subscribestar.com'],
+    'gumroad': ['gumroad.com'],
+    'discord': ['discord.com', 'discordapp.com', 'discordapp.net'],
+    'dlsite': ['dlsite.com']
+}
+
+def get_upstream(url):
+    """
+    Returns the service a url belongs to, or its host if it belongs to none of them.
+    """
+    host = (urlparse(url).hostname or '').lower()
+    for service, hosts in service_hosts.items():
+        for service_host in hosts:
+            if host == service_host or host.endswith('.' + service_host):
+                return service
+    return host
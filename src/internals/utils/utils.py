@@ -51,11 +51,4 @@ def parse_date(string, default = None):
     except:
         if default is None:
             return datetime(1970, 1, 1)
-        return default
-
-def get_hash_of_file(filename):
-    with open(filename, 'rb') as f:
-        file_hash_raw = hashlib.sha256()
-        for chunk in iter(lambda: f.read(8192), b''):
-            file_hash_raw.update(chunk)
-        return file_hash_raw.hexdigest()
\ No newline at end of file
+        return default
\ No newline at end of file
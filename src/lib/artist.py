@@ -1,10 +1,12 @@
 from bs4 import BeautifulSoup
-import cloudscraper
+import hashlib
 import requests
 import logging
 import config
 
 from ..internals.utils.proxy import get_proxy
+from ..internals.utils.scrapper import create_scrapper_session
+from ..internals.utils.session_pool import get_session
 from ..internals.cache.redis import delete_keys, delete_keys_pattern
 from ..internals.database.database import get_raw_conn, return_conn, get_cursor
 
@@ -68,32 +70,36 @@ def delete_all_artist_keys():
     
     delete_keys(keys)
 
-def dm_exists(service, artist_id, dm_id, content):
+def get_dm_content_hash(content):
+    """
+    Digest DMs are matched by, the same as the `content_hash` column computes.
+    """
+    return hashlib.sha256(content.strip(' \t\r\n').encode('utf-8')).hexdigest()
+
+def get_existing_dm_ids(service, dms):
+    """
+    Takes `(artist_id, dm_id, content)` for a page of DMs and returns the ids of those already archived,
+    matched by id or by content, in a single query.
+    """
+    if not dms:
+        return set()
+    dms = [(artist_id, dm_id, get_dm_content_hash(content)) for artist_id, dm_id, content in dms]
     conn = get_raw_conn()
     cursor = conn.cursor()
-    cursor.execute("SELECT id FROM dms WHERE id = %s AND \"user\" = %s AND service = %s", (dm_id, artist_id, service,))
-    existing_dms_by_id = cursor.fetchall()
+    cursor.execute(
+        'SELECT id, "user", content_hash FROM dms WHERE service = %s AND ("user", id) IN (SELECT * FROM unnest(%s::varchar[], %s::varchar[])) '
+        'UNION ALL SELECT id, "user", content_hash FROM dms WHERE service = %s AND ("user", content_hash) IN (SELECT * FROM unnest(%s::varchar[], %s::varchar[]))',
+        (
+            service, [dm[0] for dm in dms], [dm[1] for dm in dms],
+            service, [dm[0] for dm in dms], [dm[2] for dm in dms]
+        )
+    )
+    existing_dms = cursor.fetchall()
     cursor.close()
     return_conn(conn)
-    if (len(existing_dms_by_id) > 0):
-        return True
-    else:
-        conn2 = get_raw_conn()
-        cursor2 = conn2.cursor()
-        cursor2.execute("SELECT * FROM dms WHERE content = %s AND \"user\" = %s AND service = %s", (content, artist_id, service,))
-        existing_dms_by_content = cursor2.fetchall()
-        cursor2.close()
-        return_conn(conn2)
-        return len(existing_dms_by_content) > 0
-
-def is_artist_dnp(service, artist_id):
-    conn = get_raw_conn()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM dnp WHERE id = %s AND service = %s", (artist_id, service,))
-    results = cursor.fetchall()
-    cursor.close()
-    return_conn(conn)
-    return len(results) > 0
+    existing_ids = set((dm['user'], dm['id']) for dm in existing_dms)
+    existing_hashes = set((dm['user'], dm['content_hash']) for dm in existing_dms)
+    return set(dm_id for artist_id, dm_id, content_hash in dms if (artist_id, dm_id) in existing_ids or (artist_id, content_hash) in existing_hashes)
 
 def index_artists():
     conn = get_raw_conn()
@@ -105,7 +111,7 @@ def index_artists():
     for post in results:
         try:
             if post["service"] == 'patreon':
-                scraper = cloudscraper.create_scraper()
+                scraper = create_scrapper_session()
                 user = scraper.get('https://api.patreon.com/user/' + post["user"], proxies=get_proxy()).json()
                 model = {
                     "id": post["user"],
@@ -113,14 +119,14 @@ def index_artists():
                     "service": "patreon"
                 }
             elif post["service"] == 'fanbox':
-                user = requests.get('https://api.fanbox.cc/creator.get?userId=' + post["user"], proxies=get_proxy(), headers={"origin":"https://fanbox.cc"}).json()
+                user = get_session().get('https://api.fanbox.cc/creator.get?userId=' + post["user"], proxies=get_proxy(), headers={"origin":"https://fanbox.cc"}).json()
                 model = {
                     "id": post["user"],
                     "name": user["body"]["creatorId"],
                     "service": "fanbox"
                 }
             elif post["service"] == 'gumroad':
-                scraper = cloudscraper.create_scraper()
+                scraper = create_scrapper_session()
                 resp = scraper.get('https://gumroad.com/' + post["user"], proxies=get_proxy()).text
                 soup = BeautifulSoup(resp, 'html.parser')
                 model = {
@@ -129,7 +135,7 @@ def index_artists():
                     "service": "gumroad"
                 }
             elif post["service"] == 'subscribestar':
-                scraper = cloudscraper.create_scraper()
+                scraper = create_scrapper_session()
                 resp = scraper.get('https://subscribestar.adult/' + post["user"], proxies=get_proxy()).text
                 soup = BeautifulSoup(resp, 'html.parser')
                 model = {
@@ -138,14 +144,14 @@ def index_artists():
                     "service": "subscribestar"
                 }
             elif post["service"] == 'fantia':
-                user = requests.get('https://fantia.jp/api/v1/fanclubs/' + post["user"], proxies=get_proxy()).json()
+                user = get_session().get('https://fantia.jp/api/v1/fanclubs/' + post["user"], proxies=get_proxy()).json()
                 model = {
                     "id": post["user"],
                     "name": user["fanclub"]["creator_name"],
                     "service": "fantia"
                 }
             elif post["service"] == 'dlsite':
-                resp = requests.get('https://www.dlsite.com/eng/circle/profile/=/maker_id/' + post["user"], proxies=get_proxy()).text
+                resp = get_session().get('https://www.dlsite.com/eng/circle/profile/=/maker_id/' + post["user"], proxies=get_proxy()).text
                 soup = BeautifulSoup(resp, 'html.parser')
                 model = {
                     "id": post["user"],
@@ -0,0 +1,29 @@
+import config
+import time
+from threading import Lock
+from .artist import get_all_dnp
+
+# the list is changed outside the importer, so a copy is trusted for this long before it is reloaded
+dnp_cache_ttl = getattr(config, 'dnp_cache_ttl', 60)
+
+entries = frozenset()
+loaded_at = 0
+lock = Lock()
+
+def refresh():
+    global entries, loaded_at
+    if loaded_at and time.monotonic() - loaded_at < dnp_cache_ttl:
+        return
+    with lock:
+        if loaded_at and time.monotonic() - loaded_at < dnp_cache_ttl:
+            return
+        entries = frozenset((artist['service'], str(artist['id'])) for artist in get_all_dnp())
+        loaded_at = time.monotonic()
+
+def is_dnp(service, artist_id):
+    """
+    Whether the artist is on the do not post list, looked up in a copy of the list shared by the whole process.
+    Changes to the list are seen once the copy is older than `dnp_cache_ttl`.
+    """
+    refresh()
+    return (service, str(artist_id)) in entries
@@ -0,0 +1,46 @@
+import sys
+from .artist import get_all_artist_post_ids, get_all_artist_flagged_post_ids
+from ..internals.utils.logger import log
+
+class PostExistenceIndex:
+    """
+    The ids of the posts already archived, and of those flagged for reimport, of every creator an import comes across.
+    Each creator's ids are loaded once, on first lookup, into sets so every check after that is constant time.
+    """
+    def __init__(self, service, import_id = None):
+        self.service = service
+        self.import_id = import_id
+        self.post_ids = {}
+        self.flagged_post_ids = {}
+
+    def load(self, user_id):
+        if user_id in self.post_ids:
+            return
+        self.post_ids[user_id] = frozenset(str(post['id']) for post in get_all_artist_post_ids(self.service, user_id))
+        self.flagged_post_ids[user_id] = frozenset(str(flag['id']) for flag in get_all_artist_flagged_post_ids(self.service, user_id))
+        if self.import_id:
+            log(self.import_id, f'Loaded {len(self.post_ids[user_id])} existing posts of user {user_id}; existence index is {self.get_memory_footprint() // 1024} KiB', to_client = False)
+
+    def exists(self, user_id, post_id):
+        self.load(user_id)
+        return str(post_id) in self.post_ids[user_id]
+
+    def is_flagged(self, user_id, post_id):
+        self.load(user_id)
+        return str(post_id) in self.flagged_post_ids[user_id]
+
+    def should_skip(self, user_id, post_id):
+        """
+        Whether the post is archived already and nobody asked for it to be imported again.
+        """
+        return self.exists(user_id, post_id) and not self.is_flagged(user_id, post_id)
+
+    def get_memory_footprint(self):
+        """
+        Bytes taken by the sets and the ids in them.
+        """
+        size = 0
+        for sets in (self.post_ids, self.flagged_post_ids):
+            for ids in sets.values():
+                size += sys.getsizeof(ids) + sum(sys.getsizeof(post_id) for post_id in ids)
+        return size
@@ -1,5 +1,57 @@
 from ..internals.database.database import get_raw_conn, return_conn, get_cursor
+from psycopg2.extras import execute_values
 from datetime import datetime
+from threading import Lock
+import time
+from urllib.parse import urlsplit, urlunsplit, unquote
+
+# query parameters that only sign or expire a url; the rest of the url still identifies the file
+signed_query_params = {
+    'token-time', 'token-hash', # patreon
+    'Expires', 'Signature', 'Key-Pair-Id', 'Policy', # cloudfront
+}
+signed_query_param_prefixes = ('X-Amz-',)
+# names too short to be told apart from a real parameter on other hosts
+host_signed_query_params = {
+    'cdn.discordapp.com': {'ex', 'is', 'hm'},
+    'media.discordapp.net': {'ex', 'is', 'hm'},
+}
+
+def normalize_remote_path(url: str):
+    parts = urlsplit(url)
+    signed = signed_query_params | host_signed_query_params.get((parts.hostname or '').lower(), set())
+    # the query is filtered as raw text so the parameters that are kept stay byte-for-byte the same
+    query = [
+        param for param in parts.query.split('&')
+        if param and unquote(param.partition('=')[0]) not in signed
+        and not unquote(param.partition('=')[0]).startswith(signed_query_param_prefixes)
+    ]
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, '&'.join(query), parts.fragment))
+
+def get_file_by_remote_path(remote_path: str):
+    conn = get_raw_conn()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT
+                files.hash,
+                files.mtime,
+                files.ctime,
+                files.mime,
+                files.ext,
+                COALESCE(
+                    (SELECT filename FROM file_post_relationships WHERE file_id = files.id LIMIT 1),
+                    (SELECT filename FROM file_discord_message_relationships WHERE file_id = files.id LIMIT 1)
+                ) AS filename
+            FROM file_server_relationships
+            INNER JOIN files ON files.id = file_server_relationships.file_id
+            WHERE file_server_relationships.remote_path = %s
+            LIMIT 1
+        """, (remote_path,))
+        return cursor.fetchone()
+    finally:
+        return_conn(conn)
+
 def write_file_log(
     fhash: str,
     mtime: datetime,
@@ -17,21 +69,194 @@ def write_file_log(
     discord_message_channel: str = '',
     discord_message_id: str = '',
 ):
+    write_file_logs([dict(
+        fhash=fhash,
+        mtime=mtime,
+        ctime=ctime,
+        mime=mime,
+        ext=ext,
+        filename=filename,
+        service=service,
+        user=user,
+        post=post,
+        inline=inline,
+        remote_path=remote_path,
+        discord=discord,
+        discord_message_server=discord_message_server,
+        discord_message_channel=discord_message_channel,
+        discord_message_id=discord_message_id
+    )])
+
+def get_file_ids(cursor, files):
+    """
+    Returns the ids of the given files (file log entries) by hash, inserting the ones that aren't known yet.
+    Known files are only read: upserting them would write a new row version (and WAL) for every duplicate download.
+    """
+    hashes = [entry['fhash'] for entry in files]
+    cursor.execute("SELECT id, hash FROM files WHERE hash = ANY(%s)", (hashes,))
+    file_ids = {row['hash']: row['id'] for row in cursor.fetchall()}
+
+    new_files = [entry for entry in files if entry['fhash'] not in file_ids]
+    if new_files:
+        inserted_rows = execute_values(
+            cursor,
+            "INSERT INTO files (hash, mtime, ctime, mime, ext) VALUES %s ON CONFLICT (hash) DO NOTHING RETURNING id, hash",
+            [(entry['fhash'], entry['mtime'], entry['ctime'], entry['mime'], entry['ext']) for entry in new_files],
+            fetch=True
+        )
+        file_ids.update({row['hash']: row['id'] for row in inserted_rows})
+
+    # files inserted by another import in the meantime aren't returned by `DO NOTHING`
+    raced_hashes = [fhash for fhash in hashes if fhash not in file_ids]
+    if raced_hashes:
+        cursor.execute("SELECT id, hash FROM files WHERE hash = ANY(%s)", (raced_hashes,))
+        file_ids.update({row['hash']: row['id'] for row in cursor.fetchall()})
+
+    return file_ids
+
+def write_file_logs(entries):
+    """
+    Writes many file log entries (keyword arguments of `write_file_log`) in one transaction,
+    with one multi-row statement per table.
+    """
+    if not entries:
+        return
+
     conn = get_raw_conn()
+    try:
+        cursor = conn.cursor()
+        files = {entry['fhash']: entry for entry in entries}
+        file_ids = get_file_ids(cursor, files.values())
+
+        discord_rows = [
+            (file_ids[entry['fhash']], entry['filename'], entry['discord_message_server'], entry['discord_message_channel'], entry['discord_message_id'])
+            for entry in entries if entry['discord']
+        ]
+        if discord_rows:
+            execute_values(cursor, "INSERT INTO file_discord_message_relationships (file_id, filename, server, channel, id) VALUES %s ON CONFLICT DO NOTHING", discord_rows)
+
+        post_rows = [
+            (file_ids[entry['fhash']], entry['filename'], entry['service'], entry['user'], entry['post'], entry['inline'])
+            for entry in entries if not entry['discord']
+        ]
+        if post_rows:
+            execute_values(cursor, "INSERT INTO file_post_relationships (file_id, filename, service, \"user\", post, inline) VALUES %s ON CONFLICT DO NOTHING", post_rows)
+
+        # the existence check covers the time before the unique index is built (see `dedup_file_server_relationships`)
+        execute_values(
+            cursor,
+            """
+            INSERT INTO file_server_relationships (file_id, remote_path)
+            SELECT new.file_id, new.remote_path FROM (VALUES %s) AS new (file_id, remote_path)
+            WHERE NOT EXISTS (
+                SELECT 1 FROM file_server_relationships
+                WHERE file_id = new.file_id AND remote_path = new.remote_path
+            )
+            ON CONFLICT DO NOTHING
+            """,
+            list(set((file_ids[entry['fhash']], entry['remote_path']) for entry in entries))
+        )
 
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO files (hash, mtime, ctime, mime, ext) VALUES (%s, %s, %s, %s, %s) ON CONFLICT (hash) DO UPDATE SET hash = EXCLUDED.hash RETURNING id", (fhash, mtime, ctime, mime, ext))
-    file_id = cursor.fetchone()['id']
+        conn.commit()
+    finally:
+        return_conn(conn)
 
-    if (discord):
+class FileLogBatch:
+    """
+    Collects file log entries and writes them together with `write_file_logs`.
+    Entries are flushed on `flush()`, or on `add()` once the batch holds `max_size` entries
+    or its oldest entry is `max_age` seconds old.
+    """
+    def __init__(self, max_size: int = 500, max_age: float = 5.0):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.entries = []
+        self.started = None
+        self.lock = Lock()
+
+    def add(self, **entry):
+        with self.lock:
+            if not self.entries:
+                self.started = time.monotonic()
+            self.entries.append(entry)
+            full = len(self.entries) >= self.max_size or time.monotonic() - self.started >= self.max_age
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            entries, self.entries = self.entries, []
+        write_file_logs(entries)
+
+def dedup_file_server_relationships(from_file_id: int, to_file_id: int):
+    """
+    Deletes duplicate file server relationships of files with ids in `[from_file_id, to_file_id)`.
+    Returns the number of deleted rows.
+    """
+    conn = get_raw_conn()
+    try:
         cursor = conn.cursor()
-        cursor.execute("INSERT INTO file_discord_message_relationships (file_id, filename, server, channel, id) VALUES (%s, %s, %s, %s, %s) ON CONFLICT DO NOTHING", (file_id, filename, discord_message_server, discord_message_channel, discord_message_id))
-    else:
+        cursor.execute("""
+            DELETE FROM file_server_relationships AS duplicate
+            USING file_server_relationships AS original
+            WHERE duplicate.file_id = original.file_id
+                AND duplicate.remote_path = original.remote_path
+                AND duplicate.ctid > original.ctid
+                AND duplicate.file_id >= %s
+                AND duplicate.file_id < %s
+        """, (from_file_id, to_file_id))
+        deleted = cursor.rowcount
+        conn.commit()
+        return deleted
+    finally:
+        return_conn(conn)
+
+def get_max_file_id():
+    conn = get_raw_conn()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT MAX(id) AS max_id FROM files")
+        return cursor.fetchone()['max_id'] or 0
+    finally:
+        return_conn(conn)
+
+def file_server_relationships_unique_index_exists():
+    conn = get_raw_conn()
+    try:
+        cursor = conn.cursor()
+        # a failed concurrent build leaves the index behind, marked invalid
+        cursor.execute("""
+            SELECT 1 FROM pg_index
+            WHERE indexrelid = to_regclass('file_server_relationships_file_id_remote_path_key') AND indisvalid
+        """)
+        return cursor.fetchone() is not None
+    finally:
+        return_conn(conn)
+
+def drop_file_server_relationships_unique_index():
+    """
+    Drops the unique index, e.g. when it was left invalid by a failed build
+    (it would still reject some writes while never being usable).
+    """
+    conn = get_raw_conn()
+    try:
+        conn.autocommit = True
+        cursor = conn.cursor()
+        cursor.execute("DROP INDEX CONCURRENTLY IF EXISTS file_server_relationships_file_id_remote_path_key")
+    finally:
+        conn.autocommit = False
+        return_conn(conn)
+
+def create_file_server_relationships_unique_index():
+    conn = get_raw_conn()
+    try:
+        # concurrent index builds can't run inside a transaction, but don't block writers
+        conn.autocommit = True
         cursor = conn.cursor()
-        cursor.execute("INSERT INTO file_post_relationships (file_id, filename, service, \"user\", post, inline) VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING", (file_id, filename, service, user, post, inline))
-    
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO file_server_relationships (file_id, remote_path) VALUES (%s, %s)", (file_id, remote_path))
-    
-    conn.commit()
-    return_conn(conn)
\ No newline at end of file
+        # an index left invalid by an interrupted build has to be dropped before it can be built again
+        cursor.execute("DROP INDEX CONCURRENTLY IF EXISTS file_server_relationships_file_id_remote_path_key")
+        cursor.execute("CREATE UNIQUE INDEX CONCURRENTLY file_server_relationships_file_id_remote_path_key ON file_server_relationships USING btree (file_id, remote_path)")
+        cursor.execute("DROP INDEX CONCURRENTLY IF EXISTS file_server_relationships_file_id_remote_path_idx")
+    finally:
+        conn.autocommit = False
+        return_conn(conn)
@@ -0,0 +1,96 @@
+from ..internals.database.database import get_raw_conn, return_conn
+from ..internals.utils.logger import log
+from psycopg2.extras import execute_values
+
+class PageWriter:
+    """
+    Collects the rows an importer makes from one page of an API and upserts them together:
+    one multi-row statement per set of columns, committed once per `flush()`.
+    Rows with the same `conflict_columns` values are written once, the last one added winning.
+    `after` actions passed to `add()` (`(function, *args)` tuples) run once the row is committed,
+    and only once per flush however many rows asked for them, so per-artist work like
+    `update_artist` and cache bans happen once per page.
+    """
+    def __init__(self, table, conflict_columns = None, casts = None, update = True, import_id = None):
+        self.table = table
+        self.conflict_columns = conflict_columns
+        # column -> postgres type the value has to be cast to, e.g. `jsonb[]`
+        self.casts = casts or {}
+        # whether conflicting rows are updated, or left alone
+        self.update = update
+        self.import_id = import_id
+        self.rows = {}
+        self.after = {}
+
+    def add(self, model, after = None):
+        key = tuple(model[column] for column in self.conflict_columns) if self.conflict_columns else len(self.rows)
+        self.rows.pop(key, None)
+        self.rows[key] = model
+        self.after[key] = after or []
+
+    def get_query(self, columns):
+        conflict = 'ON CONFLICT DO NOTHING'
+        if self.conflict_columns:
+            conflict = 'ON CONFLICT ({keys}) {action}'.format(
+                keys = ','.join(self.conflict_columns),
+                action = 'DO UPDATE SET ' + ','.join([f'{column}=EXCLUDED.{column}' for column in columns]) if self.update else 'DO NOTHING'
+            )
+        query = 'INSERT INTO {table} ({fields}) VALUES %s {conflict}'.format(
+            table = self.table,
+            fields = ','.join(columns),
+            conflict = conflict
+        )
+        template = '({})'.format(','.join([f'%s::{self.casts[column]}' if column in self.casts else '%s' for column in columns]))
+        return query, template
+
+    def write(self, models):
+        # models may not all have the same columns
+        groups = {}
+        for model in models:
+            groups.setdefault(tuple(model.keys()), []).append(list(model.values()))
+        conn = get_raw_conn()
+        try:
+            cursor = conn.cursor()
+            for columns, values in groups.items():
+                query, template = self.get_query(columns)
+                execute_values(cursor, query, values, template=template, page_size=len(values))
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        finally:
+            return_conn(conn)
+
+    def flush(self):
+        """
+        Writes the collected rows and runs their `after` actions.
+        If the page can't be written at once, rows are written one by one so a bad row only loses itself.
+        """
+        rows, self.rows = self.rows, {}
+        after, self.after = self.after, {}
+        if not rows:
+            return
+        try:
+            self.write(rows.values())
+            written = list(rows.keys())
+        except:
+            written = []
+            for key, model in rows.items():
+                try:
+                    self.write([model])
+                    written.append(key)
+                except:
+                    if self.import_id:
+                        log(self.import_id, f"Error while saving {model.get('id')} to {self.table}", 'exception')
+        # compared rather than hashed, as the arguments of an action may be lists or dicts
+        actions = []
+        for key in written:
+            for action in after[key]:
+                if action not in actions:
+                    actions.append(action)
+        for function, *args in actions:
+            try:
+                function(*args)
+            except:
+                if self.import_id:
+                    log(self.import_id, f'Error while running {function.__name__} after saving to {self.table}', 'exception')
@@ -21,15 +21,6 @@ def delete_all_post_cache_keys():
 
     delete_keys(keys)
 
-def post_exists(service, artist_id, post_id):
-    conn = get_raw_conn()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM posts WHERE id = %s AND \"user\" = %s AND service = %s", (post_id, artist_id, service,))
-    existing_posts = cursor.fetchall()
-    cursor.close()
-    return_conn(conn)
-    return len(existing_posts) > 0
-
 def get_comments_for_posts(service, post_id):
     conn = get_raw_conn()
     cursor = conn.cursor()
@@ -39,14 +30,19 @@ def get_comments_for_posts(service, post_id):
     return_conn(conn)
     return existing_posts
 
-def comment_exists(service, commenter_id, comment_id):
+def get_existing_comment_ids(service, comment_ids):
+    """
+    Returns which of `comment_ids` are already archived, in a single query.
+    """
+    if not comment_ids:
+        return set()
     conn = get_raw_conn()
     cursor = conn.cursor()
-    cursor.execute("SELECT id FROM comments WHERE id = %s AND commenter = %s AND service = %s", (comment_id, commenter_id, service,))
-    existing_posts = cursor.fetchall()
+    cursor.execute("SELECT id FROM comments WHERE service = %s AND id = ANY(%s)", (service, list(comment_ids)))
+    existing_comments = cursor.fetchall()
     cursor.close()
     return_conn(conn)
-    return len(existing_posts) > 0
+    return set(comment['id'] for comment in existing_comments)
 
 def post_flagged(service, artist_id, post_id):
     conn = get_raw_conn()
@@ -57,14 +53,19 @@ def post_flagged(service, artist_id, post_id):
     return_conn(conn)
     return len(existing_flags) > 0
 
-def discord_post_exists(server_id, channel_id, post_id):
+def get_existing_discord_post_ids(server_id, channel_id, post_ids):
+    """
+    Returns which of `post_ids` are already archived for the channel, in a single query.
+    """
+    if not post_ids:
+        return set()
     conn = get_raw_conn()
     cursor = conn.cursor()
-    cursor.execute("SELECT id FROM discord_posts WHERE id = %s AND server = %s AND channel = %s", (post_id, server_id, channel_id))
+    cursor.execute("SELECT id FROM discord_posts WHERE server = %s AND channel = %s AND id = ANY(%s)", (server_id, channel_id, list(post_ids)))
     existing_posts = cursor.fetchall()
     cursor.close()
     return_conn(conn)
-    return len(existing_posts) > 0
+    return set(post['id'] for post in existing_posts)
 
 def delete_post_flags(service, artist_id, post_id):
     conn = get_raw_conn()
@@ -0,0 +1,32 @@
+from flask import Flask
+import argparse
+import logging
+
+from src.internals.database import database, migrations
+from src.internals.cache import redis
+from src.internals.utils.flask_thread import FlaskThread
+from src.internals.utils import key_watcher, indexer, file_dedup
+
+# runs imports queued by the web app (see `embedded_worker`), along with the indexer and other background jobs,
+# in a process of its own; start as many as needed with `python worker.py`
+app = Flask(__name__)
+
+logging.basicConfig(filename='kemono_worker.log', level=logging.DEBUG)
+logging.getLogger('requests').setLevel(logging.WARNING)
+logging.getLogger('urllib3').setLevel(logging.WARNING)
+
+def run(imports_only=False):
+    database.init()
+    redis.init()
+    migrations.apply()
+    with app.app_context():
+        if not imports_only:
+            FlaskThread(target=indexer.run, daemon=True).start()
+            FlaskThread(target=file_dedup.run, daemon=True).start()
+        key_watcher.watch()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    # background jobs only need to run in one worker
+    parser.add_argument('--imports-only', action='store_true', help='only run imports, leaving the indexer and other background jobs to another worker')
+    run(parser.parse_args().imports_only)